@@ -0,0 +1,38 @@
+"""
+bench_timing
+~~~~~~~~~~~~
+
+pytest plugin, loaded by bench_trello.py with ``-p bench_timing``, that
+records time spent in collection, pytest_collection_finish (where
+pytest-trello resolves cards) and pytest_runtest_setup.  The timings are
+written as JSON to the path in the BENCH_TIMING_OUTPUT environment variable.
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+import os
+import json
+import time
+import pytest
+
+timings = dict(collection=0.0, prefetch=0.0, setup=0.0)
+
+
+def _timed(phase):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        yield
+        timings[phase] += time.time() - start
+    return pytest.hookimpl(hookwrapper=True)(wrapper)
+
+
+pytest_collection = _timed('collection')
+pytest_collection_finish = _timed('prefetch')
+pytest_runtest_setup = _timed('setup')
+
+
+def pytest_unconfigure(config):
+    path = os.environ.get('BENCH_TIMING_OUTPUT')
+    if path:
+        with open(path, 'w') as fd:
+            json.dump(timings, fd)
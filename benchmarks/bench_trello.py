@@ -0,0 +1,128 @@
+"""
+bench_trello
+~~~~~~~~~~~~
+
+Benchmark the overhead pytest-trello adds to a test run.
+
+Starts a FakeTrello server, generates synthetic test suites and runs each
+suite twice in a subprocess: once with pytest-trello disabled, and once with
+pytest-trello pointed at the fake server.  Reports the wall time added to
+collection, card resolution (pytest_collection_finish) and
+pytest_runtest_setup, along with the number of trello requests.
+
+    python benchmarks/bench_trello.py --items 1000,10000 --cards 10,1000 --latency 0.05
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_trello import FakeTrello  # noqa
+
+ITEMS_PER_MODULE = 1000
+
+
+def generate_suite(path, items, cards):
+    '''Write a suite of items tests to path, each linked to one of cards
+    trello cards.'''
+    for module in range(0, items, ITEMS_PER_MODULE):
+        lines = ['import pytest\n']
+        for item in range(module, min(items, module + ITEMS_PER_MODULE)):
+            lines.append("@pytest.mark.trello('https://trello.com/c/card%05d')\n" % (item % cards))
+            lines.append("def test_%d():\n    pass\n" % item)
+        with open(os.path.join(path, 'test_bench_%d.py' % module), 'w') as fd:
+            fd.writelines(lines)
+
+
+def run_pytest(path, args):
+    '''Run pytest on path, returning the total wall time and the timings
+    recorded by bench_timing.'''
+    output = os.path.join(path, 'timings.json')
+    env = dict(os.environ)
+    env['BENCH_TIMING_OUTPUT'] = output
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH', '')])
+    cmd = [sys.executable, '-m', 'pytest', '-q', '-p', 'bench_timing', '-p', 'no:cacheprovider', path] + args
+
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(cmd, cwd=path, env=env, stdout=devnull, stderr=devnull)
+    elapsed = time.time() - start
+
+    with open(output, 'r') as fd:
+        timings = json.load(fd)
+    timings['total'] = elapsed
+    return timings
+
+
+def run_scenario(server, items, cards, trello_args):
+    '''Benchmark a single suite of items tests linked to cards cards.'''
+    path = tempfile.mkdtemp(prefix='pytest-trello-bench-')
+    try:
+        generate_suite(path, items, cards)
+        baseline = run_pytest(path, ['-p', 'no:pytest-trello'])
+
+        server.reset()
+        args = ['--trello-api-url', server.url, '--trello-api-key', 'bench',
+                '--trello-api-token', 'bench'] + trello_args
+        measured = run_pytest(path, args)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    result = dict(items=items, cards=cards, requests=server.requests, endpoints=dict(server.stats))
+    for phase in ('total', 'collection', 'prefetch', 'setup'):
+        result[phase] = measured[phase] - baseline[phase]
+    return result
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--items', default='1000,10000',
+                      help='Comma separated number of test items (default: %default)')
+    parser.add_option('--cards', default='10,1000',
+                      help='Comma separated number of unique trello cards (default: %default)')
+    parser.add_option('--boards', type='int', default=1, help='Number of boards (default: %default)')
+    parser.add_option('--latency', type='float', default=0.05,
+                      help='Seconds added to every trello request (default: %default)')
+    parser.add_option('--error-rate', type='float', default=0.0,
+                      help='Fraction of trello requests failing with 503 (default: %default)')
+    parser.add_option('--rate-limit', type='int', default=None,
+                      help='Requests per second before the server responds with 429')
+    parser.add_option('--trello-args', default='--trello-rate 0',
+                      help='Additional pytest-trello arguments (default: %default)')
+    parser.add_option('--json', dest='json_path', default=None, help='Write results as JSON to JSON_PATH')
+    (opts, args) = parser.parse_args(args)
+
+    items = [int(value) for value in opts.items.split(',')]
+    cards = [int(value) for value in opts.cards.split(',')]
+    server = FakeTrello(cards=max(cards), boards=opts.boards, latency=opts.latency,
+                        error_rate=opts.error_rate, rate_limit=opts.rate_limit).start()
+
+    results = []
+    print("%8s %8s %10s %12s %10s %10s %9s" % ('items', 'cards', 'total+', 'collection+', 'prefetch+', 'setup+', 'requests'))
+    try:
+        for num_items in items:
+            for num_cards in cards:
+                result = run_scenario(server, num_items, num_cards, opts.trello_args.split())
+                results.append(result)
+                print("%8d %8d %9.2fs %11.2fs %9.2fs %9.2fs %9d" % (
+                    result['items'], result['cards'], result['total'], result['collection'] - result['prefetch'],
+                    result['prefetch'], result['setup'], result['requests']))
+    finally:
+        server.stop()
+
+    if opts.json_path:
+        with open(opts.json_path, 'w') as fd:
+            json.dump(results, fd, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+fake_trello
+~~~~~~~~~~~
+
+A local stand-in for the trello REST endpoints used by pytest-trello, with
+configurable latency, error rate and rate limiting.
+
+Card short links are expected to end in a number (e.g. card00042).  Card N
+is placed on board N % boards, in list N % lists of that board, unless it
+was moved with move_card().  The first list of every board is named 'Done',
+all other lists are named 'Doing'.  Batch requests of up to 10 card, list
+and board urls are answered as a single request.
+
+    python benchmarks/fake_trello.py --port 8080 --cards 1000 --latency 0.1
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+import re
+import sys
+import json
+import time
+import random
+import optparse
+import threading
+from collections import defaultdict
+
+if sys.version_info < (3, 0):
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+def filter_fields(body, fields):
+    '''Returns the id, and requested fields, of an entity or a list of
+    entities, like trello does for the fields parameter.'''
+    if isinstance(body, list):
+        return [filter_fields(entity, fields) for entity in body]
+    return dict((key, value) for (key, value) in body.items() if key == 'id' or key in fields)
+
+
+class FakeTrelloHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    routes = [
+        ('cards', re.compile(r'^/1/cards/([^/]+)$')),
+        ('lists', re.compile(r'^/1/lists/([^/]+)$')),
+        ('boards/cards', re.compile(r'^/1/boards/([^/]+)/cards$')),
+        ('boards/lists', re.compile(r'^/1/boards/([^/]+)/lists$')),
+        ('boards/actions', re.compile(r'^/1/boards/([^/]+)/actions$')),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=None, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self, path):
+        '''Returns the endpoint, and id, of a path.'''
+        for (endpoint, pattern) in self.routes:
+            match = pattern.match(path)
+            if match is not None:
+                return (endpoint, match.group(1))
+        return (None, None)
+
+    def dispatch(self, endpoint, id, query):
+        '''Returns the status, and body, of a request.'''
+        try:
+            body = getattr(self.server, endpoint.replace('/', '_'))(id, **query)
+        except KeyError:
+            return (404, 'not found')
+        if 'fields' in query and endpoint != 'boards/actions':
+            body = filter_fields(body, query['fields'].split(','))
+        return (200, body)
+
+    def batch(self, urls):
+        '''Returns the responses to the urls of a batch request.  Successful
+        responses are keyed by their status, while failures are reported as
+        an error object, like trello does.'''
+        responses = []
+        for url in urls:
+            url = urlparse('/1' + url)
+            (endpoint, id) = self.route(url.path)
+            (status, body) = (404, 'not found')
+            if endpoint is not None:
+                query = dict((key, values[0]) for (key, values) in parse_qs(url.query).items())
+                (status, body) = self.dispatch(endpoint, id, query)
+            if status == 200:
+                responses.append({'200': body})
+            else:
+                responses.append({'name': 'Error', 'message': body, 'statusCode': status})
+        return responses
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == '/1/batch':
+            (endpoint, id) = ('batch', None)
+        else:
+            (endpoint, id) = self.route(url.path)
+        if endpoint is None:
+            return self.respond(404, 'not found')
+
+        server.record(endpoint)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.rate_limited():
+            return self.respond(429, 'rate limited', {'Retry-After': '1'})
+        if server.error_rate and random.random() < server.error_rate:
+            return self.respond(503, 'unavailable')
+
+        query = dict((key, values[0]) for (key, values) in parse_qs(url.query).items())
+        if endpoint == 'batch':
+            urls = query.get('urls', '').split(',')
+            if len(urls) > 10:
+                return self.respond(400, 'too many urls')
+            return self.respond(200, self.batch(urls))
+        self.respond(*self.dispatch(endpoint, id, query))
+
+
+class FakeTrello(ThreadingMixIn, HTTPServer):
+    '''Threaded HTTP server answering trello card, list and board requests.'''
+
+    daemon_threads = True
+
+    def __init__(self, cards=100, boards=1, lists=4, latency=0.0, error_rate=0.0,
+                 rate_limit=None, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, FakeTrelloHandler)
+        self.num_cards = cards
+        self.num_boards = boards
+        self.num_lists = lists
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.stats = defaultdict(int)
+        self.moved = dict()
+        self.actions = []
+        self._window = (0, 0)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        '''Base URL to provide to --trello-api-url.'''
+        return 'http://%s:%d/1' % self.server_address
+
+    @property
+    def requests(self):
+        return sum(self.stats.values())
+
+    def record(self, endpoint):
+        with self._lock:
+            self.stats[endpoint] += 1
+
+    def rate_limited(self):
+        '''Returns True when more than rate_limit requests arrived within the
+        current second.'''
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            (second, count) = self._window
+            now = int(time.time())
+            if now != second:
+                (second, count) = (now, 0)
+            self._window = (second, count + 1)
+            return count >= self.rate_limit
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+
+    def move_card(self, number, list_number):
+        '''Move card number to another list of its board, recording an
+        updateCard action.'''
+        card = self._card(number)
+        board = number % self.num_boards
+        before = self._list(board, int(card['idList'].rsplit('list', 1)[1]))
+        after = self._list(board, list_number)
+        with self._lock:
+            self.moved[number] = list_number
+            now = time.time()
+            self.actions.insert(0, {
+                'id': 'action%05d' % len(self.actions),
+                'type': 'updateCard',
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)) + '.%03dZ' % (now % 1 * 1000),
+                'data': {
+                    'card': {'id': card['id'], 'shortLink': card['shortLink'], 'idList': after['id']},
+                    'old': {'idList': before['id']},
+                    'listBefore': {'id': before['id'], 'name': before['name']},
+                    'listAfter': {'id': after['id'], 'name': after['name']},
+                    'board': {'id': card['idBoard']},
+                },
+            })
+
+    def _card(self, number):
+        board = number % self.num_boards
+        return {
+            'id': 'card%05d' % number,
+            'shortLink': 'card%05d' % number,
+            'name': 'synthetic card %d' % number,
+            'idBoard': 'board%d' % board,
+            'idList': 'board%d-list%d' % (board, self.moved.get(number, number % self.num_lists)),
+            'closed': False,
+            'desc': 'synthetic card %d - ' % number + 'lorem ipsum ' * 20,
+            'labels': [{'id': 'label%d' % label, 'color': 'green', 'name': 'label %d' % label} for label in range(3)],
+            'badges': {'comments': 0, 'attachments': 0, 'checkItems': 0, 'votes': 0},
+            'idMembers': [],
+        }
+
+    def _list(self, board, number):
+        return {
+            'id': 'board%d-list%d' % (board, number),
+            'idBoard': 'board%d' % board,
+            'name': number == 0 and 'Done' or 'Doing',
+            'closed': False,
+        }
+
+    def cards(self, card_id, **query):
+        digits = re.search(r'(\d+)$', card_id)
+        if digits is None or int(digits.group(1)) >= self.num_cards:
+            raise KeyError(card_id)
+        return self._card(int(digits.group(1)))
+
+    def lists(self, list_id, **query):
+        match = re.match(r'^board(\d+)-list(\d+)$', list_id)
+        if match is None:
+            raise KeyError(list_id)
+        return self._list(int(match.group(1)), int(match.group(2)))
+
+    def boards_cards(self, board_id, **query):
+        board = int(board_id.replace('board', ''))
+        return [self._card(number) for number in range(board, self.num_cards, self.num_boards)]
+
+    def boards_lists(self, board_id, **query):
+        board = int(board_id.replace('board', ''))
+        return [self._list(board, number) for number in range(self.num_lists)]
+
+    def boards_actions(self, board_id, since='', limit='50', **query):
+        actions = [action for action in self.actions
+                   if action['data']['board']['id'] == board_id and action['date'] >= since]
+        return actions[:int(limit)]
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=8080, help='Port to listen on (default: %default)')
+    parser.add_option('--cards', type='int', default=1000, help='Number of cards (default: %default)')
+    parser.add_option('--boards', type='int', default=1, help='Number of boards (default: %default)')
+    parser.add_option('--lists', type='int', default=4, help='Number of lists per board (default: %default)')
+    parser.add_option('--latency', type='float', default=0.0, help='Seconds added to every request (default: %default)')
+    parser.add_option('--error-rate', type='float', default=0.0, help='Fraction of requests failing with 503 (default: %default)')
+    parser.add_option('--rate-limit', type='int', default=None, help='Requests per second before responding with 429')
+    (opts, args) = parser.parse_args(args)
+
+    server = FakeTrello(cards=opts.cards, boards=opts.boards, lists=opts.lists, latency=opts.latency,
+                        error_rate=opts.error_rate, rate_limit=opts.rate_limit,
+                        address=('127.0.0.1', opts.port))
+    print("Serving fake trello at %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import os
+import sys
+import copy
+import json
+import time
+import signal
+import socket
+import logging
+import optparse
+import threading
+
+if sys.version_info < (3, 0):
+    from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+else:
+    from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+try:
+    from logging import NullHandler
+except ImportError:
+    from logging import Handler
+    class NullHandler(Handler):
+        def emit(self, record):
+            pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+"""
+pytest-trello
+~~~~~~~~~~~~
+
+Long-running local daemon keeping trello cards warm for every pytest run on
+a host.  The plugin sends the ids of all collected cards over a Unix socket,
+and receives a snapshot (see TrelloRegistry.dump()) in a single round trip.
+
+    pytest-trello-daemon --socket /tmp/pytest-trello.sock --refresh 60 --sync
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+
+DEFAULT_TRELLO_DAEMON_REFRESH = 60
+DEFAULT_TRELLO_DAEMON_MAX_CARDS = 10000
+DEFAULT_TRELLO_DAEMON_TIMEOUT = 5.0
+
+
+def query_daemon(path, card_ids, timeout=DEFAULT_TRELLO_DAEMON_TIMEOUT):
+    '''Returns a snapshot of the provided cards from the daemon listening on
+    path, or None when the daemon is not available.'''
+    if getattr(socket, 'AF_UNIX', None) is None or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        fd = sock.makefile('rwb')
+        fd.write(json.dumps(dict(cards=list(card_ids))).encode('utf-8') + b'\n')
+        fd.flush()
+        return json.loads(fd.readline().decode('utf-8'))
+    except (socket.error, socket.timeout, ValueError), e:
+        log.debug("Trello daemon unavailable at %s - %s" % (path, e))
+        return None
+    finally:
+        sock.close()
+
+
+class MemoryCache(object):
+    '''In-memory stand-in for config.cache.  Cached entries are replaced,
+    rather than modified, so they can be read without a lock.'''
+
+    def __init__(self, values=None):
+        self.values = values or dict()
+
+    def get(self, key, default):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def copy(self):
+        return MemoryCache(copy.deepcopy(self.values))
+
+    def merge(self, other, started):
+        '''Take the cards and lists of other, keeping any entries fetched
+        after started (when other was copied) that other lacks or holds
+        older versions of.  Any other values are taken from other.'''
+        for (key, value) in other.values.items():
+            if key not in ('trello/cards', 'trello/lists'):
+                self.values[key] = value
+                continue
+            merged = dict(value)
+            for (id, entry) in self.values.get(key, {}).items():
+                if entry['fetched'] > started and (id not in merged or merged[id]['fetched'] < entry['fetched']):
+                    merged[id] = entry
+            self.values[key] = merged
+
+
+class TrelloDaemonHandler(StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                card_ids = json.loads(line.decode('utf-8'))['cards']
+            except (ValueError, KeyError, TypeError), e:
+                log.warning("Invalid trello daemon request - %s" % e)
+                return
+            self.wfile.write(json.dumps(self.server.resolve(card_ids), separators=(',', ':')).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class TrelloDaemon(ThreadingMixIn, UnixStreamServer):
+    '''Unix socket server answering card requests from a warm cache.
+
+    Cards are resolved with the same prefetch, pytest cache and sync logic
+    the plugin uses, against an in-memory cache.  Every refresh seconds, all
+    cached cards are brought up to date, by delta sync of their boards (when
+    sync is enabled) and by fetching any cards the sync did not cover.
+
+    Warm cards are answered straight from the cache, and trello is contacted
+    without holding any lock, so a slow lookup or refresh never holds up
+    other clients.  The lock only guards updating the cache.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, path, api, refresh=DEFAULT_TRELLO_DAEMON_REFRESH, sync=False,
+                 max_cards=DEFAULT_TRELLO_DAEMON_MAX_CARDS, **kwargs):
+        if os.path.exists(path):
+            os.unlink(path)
+        UnixStreamServer.__init__(self, path, TrelloDaemonHandler)
+        os.chmod(path, 0600)
+        self.path = path
+        self.api = api
+        self.refresh = refresh
+        self.sync = sync
+        self.max_cards = max_cards
+        self.kwargs = kwargs
+        self.cache = MemoryCache()
+        self._lock = threading.Lock()
+
+    def _helper(self, max_age):
+        from pytest_trello.plugin import TrelloPytestPlugin
+        return TrelloPytestPlugin(self.api, cache=self.cache, cache_ttl=max_age, cache_max_cards=self.max_cards,
+                                  **self.kwargs)
+
+    def resolve(self, card_ids, max_age=None):
+        '''Returns a snapshot of the provided cards, fetching any cards not
+        refreshed within max_age seconds (twice the refresh interval by
+        default).'''
+        helper = self._helper(max_age or 2 * self.refresh)
+        cards = [helper.registry.card(card_id) for card_id in card_ids]
+        helper._load_cache(cards, helper.cache_ttl)
+
+        # Mark warm cards as used, so they outlive others at max_cards
+        now = time.time()
+        cached_cards = self.cache.get('trello/cards', {})
+        for card in cards:
+            entry = cached_cards.get(card.id)
+            if card._card is not None and entry is not None:
+                cached_cards[card.id] = dict(entry, used=now)
+
+        if any(card._card is None for card in cards):
+            helper.prefetch(cards)
+            with self._lock:
+                helper._save_cache()
+        return helper.registry.dump()
+
+    def poll(self):
+        '''Bring all cached cards up to date.'''
+        if self.sync:
+            from pytest_trello.sync import TrelloSync
+            # Sync a copy, so clients are answered while boards are synced
+            with self._lock:
+                (cache, started) = (self.cache.copy(), time.time())
+            TrelloSync(self.api, cache).sync()
+            with self._lock:
+                self.cache.merge(cache, started)
+        self.resolve(list(self.cache.get('trello/cards', {}).keys()), max_age=self.refresh)
+
+    def _poll_forever(self):
+        while True:
+            time.sleep(self.refresh)
+            try:
+                self.poll()
+            except Exception, e:
+                log.exception("Failed to refresh trello cards - %s" % e)
+
+    def start(self):
+        '''Serve requests, and refresh cards, on background threads.'''
+        for target in (self.serve_forever, self._poll_forever):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def main(args=None):
+    '''Console entry point running the daemon until interrupted.'''
+    import yaml
+    import trello
+    from pytest_trello.session import TrelloSession, TokenBucket
+    from pytest_trello.defaults import TRELLO_API_URL, DEFAULT_TRELLO_RATE
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--socket', default=os.path.expanduser('~/.pytest-trello.sock'),
+                      help='Unix socket to listen on (default: %default)')
+    parser.add_option('--trello-cfg', dest='trello_cfg_file', default='trello.yml',
+                      help='Trello configuration file (default: %default)')
+    parser.add_option('--trello-api-key', default=None,
+                      help='Trello API key (defaults to value supplied in TRELLO_CFG)')
+    parser.add_option('--trello-api-token', default=None,
+                      help='Trello API token (defaults to value supplied in TRELLO_CFG)')
+    parser.add_option('--trello-api-url', default=TRELLO_API_URL,
+                      help='Base URL of the trello REST api (default: %default)')
+    parser.add_option('--trello-rate', type='float', default=DEFAULT_TRELLO_RATE,
+                      help='Maximum number of trello requests per second, or 0 for no limit (default: %default)')
+    parser.add_option('--refresh', type='int', default=DEFAULT_TRELLO_DAEMON_REFRESH,
+                      help='Seconds between refreshing all cached cards (default: %default)')
+    parser.add_option('--sync', action='store_true', default=False,
+                      help='Refresh cached cards from the actions of their boards')
+    parser.add_option('--max-cards', type='int', default=DEFAULT_TRELLO_DAEMON_MAX_CARDS,
+                      help='Maximum number of cached cards (default: %default)')
+    (opts, args) = parser.parse_args(args)
+
+    trello_cfg = dict()
+    if os.path.isfile(opts.trello_cfg_file):
+        with open(opts.trello_cfg_file, 'r') as fd:
+            trello_cfg = (yaml.load(fd, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}).get('trello', {})
+    api = trello.TrelloApi(opts.trello_api_key or trello_cfg.get('key', None),
+                           opts.trello_api_token or trello_cfg.get('token', None))
+
+    limiter = opts.trello_rate > 0 and TokenBucket(opts.trello_rate) or None
+    session = TrelloSession(limiter=limiter, base_url=opts.trello_api_url)
+    session.install()
+    server = TrelloDaemon(opts.socket, api, refresh=opts.refresh, sync=opts.sync, max_cards=opts.max_cards)
+    print("Serving trello cards at %s" % opts.socket)
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.start()
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""
+pytest-trello
+~~~~~~~~~~~~
+
+Default settings of the trello HTTP session and the shared store.  Kept
+apart from pytest_trello.session and pytest_trello.store, so the plugin can
+provide its options without importing requests, sqlite3 or the trello
+library.
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+
+TRELLO_API_URL = 'https://trello.com/1'
+DEFAULT_TRELLO_POOL_SIZE = 8
+DEFAULT_TRELLO_RETRIES = 3
+DEFAULT_TRELLO_BACKOFF = 0.5
+# trello allows 100 requests per 10 seconds for each token
+DEFAULT_TRELLO_RATE = 10.0
+DEFAULT_TRELLO_TIMEOUT = 30.0
+DEFAULT_TRELLO_MAX_FAILURES = 5
+DEFAULT_TRELLO_SHARED_CACHE_TTL = 60
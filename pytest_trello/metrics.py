@@ -0,0 +1,131 @@
+import math
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+"""
+pytest-trello
+~~~~~~~~~~~~
+
+Metrics describing the overhead added by the plugin.
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+
+
+def endpoint(path):
+    '''Returns the endpoint of a trello api path, without any ids (e.g.
+    boards/54aeece5d8b09a1947f34050/cards becomes boards/cards).'''
+    return '/'.join(path.strip('/').split('/')[0::2])
+
+
+def percentile(values, percent):
+    '''Returns the nearest-rank percentile of a list of values.'''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, int(math.ceil(percent * len(values) / 100.0)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class TrelloMetrics(object):
+    '''Thread-safe counters for trello requests, rate limiting, cache usage
+    and the time spent in each plugin hook.'''
+
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.latencies = []
+        self.retries = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.max_queue_depth = 0
+        self.throttled = 0.0
+        self.rate_limited = 0
+        self.hooks = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def record_request(self, endpoint, elapsed, error=False):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.latencies.append(elapsed)
+            if error:
+                self.errors += 1
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_queue_depth(self, depth):
+        '''Record the number of requests waiting for the rate limiter.'''
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def record_throttle(self, seconds=0.0, limited=False):
+        '''Record time spent waiting for the rate limiter, or a 429 response.'''
+        with self._lock:
+            self.throttled += seconds
+            if limited:
+                self.rate_limited += 1
+
+    def record_cache(self, hits, misses):
+        with self._lock:
+            self.cache_hits += hits
+            self.cache_misses += misses
+
+    @contextmanager
+    def timed(self, hook):
+        '''Add the time spent in the with block to hook.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.hooks[hook] += time.time() - start
+
+    def dump(self):
+        '''Return a JSON serializable copy of all metrics.'''
+        with self._lock:
+            return dict(
+                requests=dict(self.requests),
+                latencies=list(self.latencies),
+                retries=self.retries,
+                errors=self.errors,
+                cache_hits=self.cache_hits,
+                cache_misses=self.cache_misses,
+                max_queue_depth=self.max_queue_depth,
+                throttled=self.throttled,
+                rate_limited=self.rate_limited,
+                hooks=dict(self.hooks),
+            )
+
+    def merge(self, data):
+        '''Add metrics previously returned by dump() (e.g. from a pytest-xdist
+        worker).'''
+        with self._lock:
+            for (name, count) in data['requests'].items():
+                self.requests[name] += count
+            self.latencies.extend(data['latencies'])
+            self.retries += data['retries']
+            self.errors += data['errors']
+            self.cache_hits += data['cache_hits']
+            self.cache_misses += data['cache_misses']
+            self.max_queue_depth = max(self.max_queue_depth, data['max_queue_depth'])
+            self.throttled += data['throttled']
+            self.rate_limited += data['rate_limited']
+            for (name, elapsed) in data['hooks'].items():
+                self.hooks[name] += elapsed
+
+    def summary(self):
+        '''Return a JSON serializable summary of all metrics.'''
+        data = self.dump()
+        latencies = data.pop('latencies')
+        data['total_requests'] = sum(data['requests'].values())
+        data['latency'] = dict(
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            max=latencies and max(latencies) or 0.0,
+        )
+        return data
@@ -1,12 +1,18 @@
 import os
+import re
+import csv
+import json
+import time
+import errno
+import hashlib
+import shutil
+import tempfile
 import logging
-import yaml
+import threading
 import pytest
-import py
-import trello
-import requests.exceptions
-from _pytest.python import getlocation
-from _pytest.resultlog import generic_path
+from pytest_trello.metrics import TrelloMetrics
+from pytest_trello.defaults import TRELLO_API_URL, DEFAULT_TRELLO_RETRIES, DEFAULT_TRELLO_RATE, \
+    DEFAULT_TRELLO_TIMEOUT, DEFAULT_TRELLO_MAX_FAILURES, DEFAULT_TRELLO_SHARED_CACHE_TTL
 
 try:
     from logging import NullHandler
@@ -26,12 +32,39 @@ pytest-trello
 pytest-trello is a plugin for py.test that allows tests to reference trello
 cards for skip/xfail handling.
 
+Runs without trello markers only pay for this module: yaml, requests and the
+trello library are imported, TRELLO_CFG is read and the trello api is built
+once the first trello marker is collected, or at session start when the
+previous run collected trello markers (see activate()).
+
 :copyright: see LICENSE for details
 :license: MIT, see LICENSE for more details.
 """
 
-_card_cache = {}
+# Bound by import_dependencies() once the plugin is activated
+yaml = trello = requests = ThreadPool = None
+TrelloSession = TokenBucket = CircuitBreaker = TrelloSharedStore = TrelloSync = query_daemon = None
+
 DEFAULT_TRELLO_COMPLETED = ['Done', 'Archived']
+DEFAULT_TRELLO_WORKERS = 8
+TRELLO_RESOLVERS = ['card', 'batch', 'board']
+# Maximum number of requests in a single trello batch request
+TRELLO_BATCH_SIZE = 10
+DEFAULT_TRELLO_CACHE_TTL = 0
+# Age at which --trello-stale-ok refreshes cached cards, without --trello-cache-ttl
+DEFAULT_TRELLO_STALE_TTL = 300
+# Number of seconds the end of the session waits for stale cards to be refreshed
+DEFAULT_TRELLO_REVALIDATE_TIMEOUT = 1.0
+TRELLO_FALLBACKS = ['complete', 'incomplete', 'cached']
+TRELLO_REPORT_FORMATS = ['text', 'json', 'csv']
+DEFAULT_TRELLO_SNAPSHOT_TIMEOUT = 300
+SNAPSHOT_VERSION = 1
+# The only card and list fields requested from trello, and stored in the cache
+TRELLO_CARD_FIELDS = ['name', 'idList', 'idBoard', 'shortLink', 'closed']
+TRELLO_LIST_FIELDS = ['name', 'idBoard', 'closed']
+TRELLO_CARD_URL = 'https://trello.com/c/{0}'
+# Matches the id of https://trello.com/c/<id>[/<number>-<slug>] and variants
+TRELLO_CARD_URL_RE = re.compile(r'^(?:[a-z]+://)?(?:[\w.-]*trello\.com)?/*c/([^/?#\s]+)', re.IGNORECASE)
 
 
 def pytest_addoption(parser):
@@ -62,11 +95,173 @@ def pytest_addoption(parser):
                     metavar='TRELLO_COMPLETED',
                     default=[],
                     help='Any cards in TRELLO_COMPLETED are considered complete (default: %s)' % DEFAULT_TRELLO_COMPLETED)
+    group.addoption('--trello-workers',
+                    action='store',
+                    dest='trello_workers',
+                    type=int,
+                    default=DEFAULT_TRELLO_WORKERS,
+                    metavar='TRELLO_WORKERS',
+                    help='Number of concurrent requests used to prefetch trello cards (default: %s)' % DEFAULT_TRELLO_WORKERS)
+    group.addoption('--trello-api-url',
+                    action='store',
+                    dest='trello_api_url',
+                    default=TRELLO_API_URL,
+                    metavar='TRELLO_API_URL',
+                    help='Base URL of the trello REST API (default: %default)')
+    group.addoption('--trello-pool-size',
+                    action='store',
+                    dest='trello_pool_size',
+                    type=int,
+                    default=None,
+                    metavar='TRELLO_POOL_SIZE',
+                    help='Number of keep-alive connections to trello (default: TRELLO_WORKERS)')
+    group.addoption('--trello-retries',
+                    action='store',
+                    dest='trello_retries',
+                    type=int,
+                    default=DEFAULT_TRELLO_RETRIES,
+                    metavar='TRELLO_RETRIES',
+                    help='Number of times a failed trello request is retried (default: %s)' % DEFAULT_TRELLO_RETRIES)
+    group.addoption('--trello-rate',
+                    action='store',
+                    dest='trello_rate',
+                    type=float,
+                    default=DEFAULT_TRELLO_RATE,
+                    metavar='TRELLO_RATE',
+                    help='Maximum number of trello requests per second, or 0 for no limit (default: %s)' % DEFAULT_TRELLO_RATE)
+    group.addoption('--trello-burst',
+                    action='store',
+                    dest='trello_burst',
+                    type=int,
+                    default=None,
+                    metavar='TRELLO_BURST',
+                    help='Maximum number of trello requests issued at once (default: TRELLO_RATE)')
+    group.addoption('--trello-timeout',
+                    action='store',
+                    dest='trello_timeout',
+                    type=float,
+                    default=DEFAULT_TRELLO_TIMEOUT,
+                    metavar='SECONDS',
+                    help='Maximum number of seconds to wait for each trello request (default: %s)' % DEFAULT_TRELLO_TIMEOUT)
+    group.addoption('--trello-timeout-total',
+                    action='store',
+                    dest='trello_timeout_total',
+                    type=float,
+                    default=None,
+                    metavar='SECONDS',
+                    help='Stop contacting trello SECONDS after the first trello request (default: no limit)')
+    group.addoption('--trello-max-failures',
+                    action='store',
+                    dest='trello_max_failures',
+                    type=int,
+                    default=DEFAULT_TRELLO_MAX_FAILURES,
+                    metavar='TRELLO_MAX_FAILURES',
+                    help=('Stop contacting trello after TRELLO_MAX_FAILURES consecutive failed requests, '
+                          'or 0 to never stop (default: %s)' % DEFAULT_TRELLO_MAX_FAILURES))
+    group.addoption('--trello-fallback',
+                    action='store',
+                    dest='trello_fallback',
+                    choices=TRELLO_FALLBACKS,
+                    default='complete',
+                    metavar='TRELLO_FALLBACK',
+                    help=('Treat cards that cannot be retrieved as complete, incomplete, or use their last cached status '
+                          '(choices: %s, default: %%default)' % ', '.join(TRELLO_FALLBACKS)))
+    group.addoption('--trello-resolver',
+                    action='store',
+                    dest='trello_resolver',
+                    choices=TRELLO_RESOLVERS,
+                    default='card',
+                    metavar='TRELLO_RESOLVER',
+                    help=('Prefetch each card individually, in batches of %d, or all cards of the referenced boards '
+                          '(choices: %s, default: %%default)' % (TRELLO_BATCH_SIZE, ', '.join(TRELLO_RESOLVERS))))
+    group.addoption('--trello-cache-ttl',
+                    action='store',
+                    dest='trello_cache_ttl',
+                    type=int,
+                    default=None,
+                    metavar='TRELLO_CACHE_TTL',
+                    help=('Number of seconds that cards are reused from the pytest cache '
+                          '(defaults to value supplied in TRELLO_CFG, or %s to disable)' % DEFAULT_TRELLO_CACHE_TTL))
+    group.addoption('--trello-cache-clear',
+                    action='store_true',
+                    dest='trello_cache_clear',
+                    default=False,
+                    help='Remove all trello cards from the pytest cache.')
+    group.addoption('--trello-cache-max-cards',
+                    action='store',
+                    dest='trello_cache_max_cards',
+                    type=int,
+                    default=0,
+                    metavar='TRELLO_CACHE_MAX_CARDS',
+                    help='Keep only the TRELLO_CACHE_MAX_CARDS most recently used cards in the pytest cache, or 0 for no limit (default: %default)')
+    group.addoption('--trello-shared-cache',
+                    action='store',
+                    dest='trello_shared_cache',
+                    default=None,
+                    metavar='PATH',
+                    help=('Share cards with all concurrent pytest processes on this host through the SQLite database at PATH '
+                          '(defaults to value supplied in TRELLO_CFG)'))
+    group.addoption('--trello-shared-cache-ttl',
+                    action='store',
+                    dest='trello_shared_cache_ttl',
+                    type=int,
+                    default=None,
+                    metavar='SECONDS',
+                    help=('Number of seconds that cards are reused from the shared cache '
+                          '(defaults to value supplied in TRELLO_CFG, or %s)' % DEFAULT_TRELLO_SHARED_CACHE_TTL))
+    group.addoption('--trello-sync',
+                    action='store_true',
+                    dest='trello_sync',
+                    default=False,
+                    help='Update cached cards from the actions of their boards since the last sync, using one request per board (requires --trello-cache-ttl).')
+    group.addoption('--trello-stale-ok',
+                    action='store_true',
+                    dest='trello_stale_ok',
+                    default=False,
+                    help=('Answer from cached cards of any age, refreshing cards older than TRELLO_CACHE_TTL (or %ss) '
+                          'in the background for the next session (requires the pytest cache).' % DEFAULT_TRELLO_STALE_TTL))
+    group.addoption('--trello-daemon',
+                    action='store',
+                    dest='trello_daemon',
+                    default=None,
+                    metavar='SOCKET',
+                    help='Resolve cards through the pytest-trello-daemon listening on SOCKET, when it is running (defaults to value supplied in TRELLO_CFG)')
+    group.addoption('--trello-snapshot-write',
+                    action='store',
+                    dest='trello_snapshot_write',
+                    default=None,
+                    metavar='PATH',
+                    help='Write the status of all resolved trello cards to PATH.')
+    group.addoption('--trello-snapshot-read',
+                    action='store',
+                    dest='trello_snapshot_read',
+                    default=None,
+                    metavar='PATH',
+                    help='Read the status of trello cards from PATH, without contacting trello.')
+    group.addoption('--trello-metrics-json',
+                    action='store',
+                    dest='trello_metrics_json',
+                    default=None,
+                    metavar='PATH',
+                    help='Write metrics describing trello requests and plugin overhead to PATH.')
     group.addoption('--show-trello-cards',
                     action='store_true',
                     dest='show_trello_cards',
                     default=False,
                     help='Show a list of all trello card markers.')
+    group.addoption('--trello-report-format',
+                    action='store',
+                    dest='trello_report_format',
+                    choices=TRELLO_REPORT_FORMATS,
+                    default='text',
+                    metavar='TRELLO_REPORT_FORMAT',
+                    help='Format of the --show-trello-cards report (choices: %s, default: %%default)' % ', '.join(TRELLO_REPORT_FORMATS))
+    group.addoption('--trello-report-output',
+                    action='store',
+                    dest='trello_report_output',
+                    default=None,
+                    metavar='PATH',
+                    help='Write the --show-trello-cards report to PATH instead of the terminal.')
 
 
 def pytest_configure(config):
@@ -78,48 +273,224 @@ def pytest_configure(config):
     # Add marker
     config.addinivalue_line("markers", """trello(*cards): Trello card integration""")
 
+    if not enabled(config):
+        return
+
+    # Clear any previously cached cards (requires the cacheprovider plugin)
+    cache = getattr(config, 'cache', None)
+    if cache is not None and config.getoption('trello_cache_clear'):
+        cache.set('trello/cards', {})
+        cache.set('trello/lists', {})
+        cache.set('trello/boards', {})
+        cache.set(collected_key(config), [])
+
+    # The pytest-xdist controller provides workers with a shared snapshot
+    workerinput = getattr(config, 'workerinput', getattr(config, 'slaveinput', None))
+    if workerinput is None and config.pluginmanager.hasplugin('xdist') and getattr(config.option, 'dist', 'no') != 'no':
+        assert config.pluginmanager.register(TrelloXdistPlugin(), 'trello_xdist')
+
+    # Fail early on a snapshot that can't be read, rather than during
+    # collection, and parse it once for the whole session
+    config._trello_snapshot_read = None
+    snapshot_read = config.getoption('trello_snapshot_read')
+    if snapshot_read is not None:
+        try:
+            config._trello_snapshot_read = read_snapshot(snapshot_read)
+        except (IOError, OSError, ValueError), e:
+            raise pytest.UsageError("Unable to read --trello-snapshot-read %s - %s" % (snapshot_read, e))
+
+    # A snapshot is written even when no trello markers are collected
+    if config.getoption('trello_snapshot_write') is not None:
+        activate(config)
+
+
+def enabled(config):
+    '''Returns False for --help, --collectonly and --showfixtures.'''
+    return not (config.option.help or config.option.collectonly or config.option.showfixtures)
+
+
+def collected_key(config):
+    '''Returns the cache key of the cards collected by runs selecting items
+    with the same arguments, -k and -m expressions.'''
+    selection = json.dumps([config.args, config.option.keyword, config.option.markexpr])
+    return 'trello/collected/%s' % hashlib.sha1(selection.encode('utf-8')).hexdigest()[:16]
+
+
+def import_dependencies():
+    '''Import the modules used once the plugin is activated, and bind them
+    to module globals.  This happens once, on the main thread, so card and
+    list lookups on worker threads never wait for the import lock.'''
+    global yaml, trello, requests, ThreadPool, TrelloSession, TokenBucket, CircuitBreaker, TrelloSharedStore, \
+        TrelloSync, query_daemon
+    if requests is not None:
+        return
+    import yaml
+    import trello
+    import requests.exceptions
+    from multiprocessing.pool import ThreadPool
+    from pytest_trello.session import TrelloSession, TokenBucket, CircuitBreaker
+    from pytest_trello.store import TrelloSharedStore
+    from pytest_trello.sync import TrelloSync
+    from pytest_trello.daemon import query_daemon
+
+
+def activate(config):
+    '''Register, and return, the trello plugin.  This is called once the
+    first trello marker is collected (or at session start, see
+    pytest_sessionstart()), and returns the registered plugin on subsequent
+    calls.'''
+    trello_helper = config.pluginmanager.getplugin('trello_helper')
+    if trello_helper is not None:
+        return trello_helper
+
+    import_dependencies()
+
     # Sanitize key and token
     trello_cfg_file = config.getoption('trello_cfg_file')
     trello_api_key = config.getoption('trello_api_key')
     trello_api_token = config.getoption('trello_api_token')
     trello_completed = config.getoption('trello_completed')
+    trello_cache_ttl = config.getoption('trello_cache_ttl')
+    trello_daemon = config.getoption('trello_daemon')
+    trello_shared_cache = config.getoption('trello_shared_cache')
+    trello_shared_cache_ttl = config.getoption('trello_shared_cache_ttl')
 
-    # If not --help or --collectonly or --showfixtures ...
-    if not (config.option.help or config.option.collectonly or config.option.showfixtures):
-        # Warn if file does not exist
-        if not os.path.isfile(trello_cfg_file):
-            errstr = "No trello configuration file found matching: %s" % trello_cfg_file
+    # Warn if file does not exist
+    if not os.path.isfile(trello_cfg_file):
+        errstr = "No trello configuration file found matching: %s" % trello_cfg_file
+        log.warning(errstr)
+
+    # Load configuration file, using the C loader when available ...
+    if os.path.isfile(trello_cfg_file):
+        with open(trello_cfg_file, 'r') as fd:
+            trello_cfg = yaml.load(fd, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        try:
+            trello_cfg = trello_cfg.get('trello', {})
+        except AttributeError:
+            trello_cfg = {}
+            errstr = "No trello configuration found in file: %s" % trello_cfg_file
             log.warning(errstr)
 
-        # Load configuration file ...
-        if os.path.isfile(trello_cfg_file):
-            trello_cfg = yaml.load(open(trello_cfg_file, 'r'))
-            try:
-                trello_cfg = trello_cfg.get('trello', {})
-            except AttributeError:
-                trello_cfg = {}
-                errstr = "No trello configuration found in file: %s" % trello_cfg_file
-                log.warning(errstr)
-
-            if trello_api_key is None:
-                trello_api_key = trello_cfg.get('key', None)
-            if trello_api_token is None:
-                trello_api_token = trello_cfg.get('token', None)
-            if trello_completed is None or trello_completed == []:
-                trello_completed = trello_cfg.get('completed', [])
-
-        # Initialize trello api connection
+        if trello_api_key is None:
+            trello_api_key = trello_cfg.get('key', None)
+        if trello_api_token is None:
+            trello_api_token = trello_cfg.get('token', None)
+        if trello_completed is None or trello_completed == []:
+            trello_completed = trello_cfg.get('completed', [])
+        if trello_cache_ttl is None:
+            trello_cache_ttl = trello_cfg.get('cache_ttl', None)
+        if trello_daemon is None:
+            trello_daemon = trello_cfg.get('daemon', None)
+        if trello_shared_cache is None:
+            trello_shared_cache = trello_cfg.get('shared_cache', None)
+        if trello_shared_cache_ttl is None:
+            trello_shared_cache_ttl = trello_cfg.get('shared_cache_ttl', None)
+
+    # Initialize trello api connection, unless working offline
+    snapshot_read = getattr(config, '_trello_snapshot_read', None)
+    metrics = TrelloMetrics()
+    if snapshot_read is None:
         api = trello.TrelloApi(trello_api_key, trello_api_token)
+        limiter = None
+        if config.getoption('trello_rate') > 0:
+            limiter = TokenBucket(config.getoption('trello_rate'), config.getoption('trello_burst'), metrics=metrics)
+        breaker = CircuitBreaker(max_failures=config.getoption('trello_max_failures'),
+                                 budget=config.getoption('trello_timeout_total'))
+        session = TrelloSession(pool_size=config.getoption('trello_pool_size') or config.getoption('trello_workers'),
+                                retries=config.getoption('trello_retries'),
+                                timeout=config.getoption('trello_timeout'),
+                                limiter=limiter,
+                                breaker=breaker,
+                                metrics=metrics,
+                                base_url=config.getoption('trello_api_url'))
+        session.install()
+    else:
+        api = None
+        session = None
+
+    # If completed is still empty, load default ...
+    if trello_completed is None or trello_completed == []:
+        trello_completed = DEFAULT_TRELLO_COMPLETED
+
+    # If no cache ttl was provided, load default ...
+    if trello_cache_ttl is None:
+        trello_cache_ttl = DEFAULT_TRELLO_CACHE_TTL
+
+    cache = getattr(config, 'cache', None)
+    store = None
+    if snapshot_read is not None:
+        cache = None
+    elif trello_shared_cache is not None:
+        if trello_shared_cache_ttl is None:
+            trello_shared_cache_ttl = DEFAULT_TRELLO_SHARED_CACHE_TTL
+        store = TrelloSharedStore(trello_shared_cache, ttl=trello_shared_cache_ttl)
+
+    # When running as a pytest-xdist worker, share resolved cards with
+    # the other workers through the snapshot provided by the controller
+    workerinput = getattr(config, 'workerinput', getattr(config, 'slaveinput', None))
+    snapshot = None
+    if snapshot_read is None and workerinput is not None and workerinput.get('trello_snapshot'):
+        snapshot = TrelloSharedSnapshot(workerinput['trello_snapshot'])
+
+    # Register pytest plugin
+    trello_helper = TrelloPytestPlugin(api, completed_lists=trello_completed,
+                                       workers=config.getoption('trello_workers'),
+                                       resolver=config.getoption('trello_resolver'),
+                                       cache=cache,
+                                       cache_ttl=trello_cache_ttl,
+                                       cache_max_cards=config.getoption('trello_cache_max_cards'),
+                                       sync=config.getoption('trello_sync'),
+                                       stale_ok=config.getoption('trello_stale_ok'),
+                                       daemon=trello_daemon,
+                                       store=store,
+                                       session=session,
+                                       metrics=metrics,
+                                       metrics_json=config.getoption('trello_metrics_json'),
+                                       fallback=config.getoption('trello_fallback'),
+                                       snapshot=snapshot,
+                                       snapshot_read=snapshot_read,
+                                       snapshot_write=config.getoption('trello_snapshot_write'))
+    assert config.pluginmanager.register(trello_helper, 'trello_helper')
+    return trello_helper
+
+
+def pytest_sessionstart(session):
+    '''Start resolving the cards collected by the previous run, so trello
+    requests overlap with collecting the items of this run.'''
+    config = session.config
+    cache = getattr(config, 'cache', None)
+    if not enabled(config) or cache is None:
+        return
+
+    # pytest-xdist workers share the cards resolved by a single worker
+    workerinput = getattr(config, 'workerinput', getattr(config, 'slaveinput', None))
+    if workerinput is not None or getattr(config.option, 'dist', 'no') != 'no':
+        return
+    card_ids = cache.get(collected_key(config), [])
+    if card_ids:
+        activate(config).prefetch_previous(card_ids)
+
+
+def pytest_collection_finish(session):
+    '''Activate the trello plugin once a selected item has a trello marker.'''
+    config = session.config
+    trello_helper = config.pluginmanager.getplugin('trello_helper')
+    if trello_helper is None:
+        if not enabled(config) or not any(item.get_marker('trello') is not None for item in session.items):
+            return
+        trello_helper = activate(config)
+    trello_helper.collection_finish(session)
 
-        # If completed is still empty, load default ...
-        if trello_completed is None or trello_completed == []:
-            trello_completed = DEFAULT_TRELLO_COMPLETED
 
-        # Register pytest plugin
-        assert config.pluginmanager.register(
-            TrelloPytestPlugin(api, completed_lists=trello_completed),
-            'trello_helper'
-        )
+def pytest_unconfigure(config):
+    '''Write zero metrics to --trello-metrics-json when the trello plugin was
+    never activated, as the path is still expected to exist.'''
+    path = config.getoption('trello_metrics_json')
+    workerinput = getattr(config, 'workerinput', getattr(config, 'slaveinput', None))
+    if path is None or workerinput is not None or config.pluginmanager.getplugin('trello_helper') is not None:
+        return
+    with open(path, 'w') as fd:
+        json.dump(TrelloMetrics().summary(), fd, indent=2)
 
 
 def pytest_cmdline_main(config):
@@ -133,141 +504,939 @@ def pytest_cmdline_main(config):
 
 def __show_trello_cards(config, session):
     '''Generate a report that includes all linked trello cards, and their status.'''
-    session.perform_collect()
-    curdir = py.path.local()
+    trello_helper = activate(config)
+    with trello_helper.metrics.timed('show_trello_cards'):
+        _show_trello_cards(config, session)
 
-    trello_helper = config.pluginmanager.getplugin("trello_helper")
 
-    card_cache = dict()
-    for i, item in enumerate(filter(lambda i: i.get_marker("trello") is not None, session.items)):
-        cards = item.funcargs.get('cards', [])
-        for card in cards:
-            if card not in card_cache:
-                card_cache[card] = list()
-            card_cache[card].append(generic_path(item))
+def _show_trello_cards(config, session):
+    # Collecting resolves all cards concurrently (see pytest_collection_finish)
+    session.perform_collect()
+    trello_helper = config.pluginmanager.getplugin("trello_helper")
+    records = trello_helper.report()
 
     reporter = config.pluginmanager.getplugin("terminalreporter")
-    reporter.section("trello card report")
-    if card_cache:
-        for card, gpaths in card_cache.items():
-            reporter.write("{0} ".format(card.url), bold=True)
-            reporter.write_line("[{0}] {1}".format(card.list.name, card.name))
-            for gpath in gpaths:
-                reporter.write_line(" * %s" % gpath)
+    output = config.getoption('trello_report_output')
+    report_format = config.getoption('trello_report_format')
+    if output is not None:
+        with open(output, 'w') as fd:
+            REPORT_WRITERS[report_format](fd, records)
+        reporter.write_line("Wrote {0} trello cards to {1}".format(len(records), output))
     else:
-        reporter.write_line("No trello cards collected")
+        reporter.section("trello card report")
+        if records:
+            REPORT_WRITERS[report_format](reporter, records)
+        else:
+            reporter.write_line("No trello cards collected")
+
+
+def write_text_report(stream, records):
+    '''Write a report of trello cards, one card per line followed by the
+    linked items, grouped by board and list.'''
+    for record in records:
+        if record['list'] is not None:
+            stream.write("{url} [{list}] {name}\n".format(**record))
+        else:
+            stream.write("{url} [unknown]\n".format(**record))
+        for nodeid in record['items']:
+            stream.write(" * {0}\n".format(nodeid))
+
+
+def write_json_report(stream, records):
+    '''Write a report of trello cards as JSON, grouped by board and list.'''
+    boards = []
+    for record in records:
+        if not boards or boards[-1]['id'] != record['board']:
+            boards.append(dict(id=record['board'], lists=[]))
+        lists = boards[-1]['lists']
+        if not lists or lists[-1]['id'] != record['idList']:
+            lists.append(dict(id=record['idList'], name=record['list'], cards=[]))
+        lists[-1]['cards'].append(dict((key, record[key]) for key in ('url', 'id', 'name', 'status', 'items')))
+    json.dump(dict(boards=boards), stream, indent=2, sort_keys=True)
+    stream.write("\n")
+
+
+def write_csv_report(stream, records):
+    '''Write a report of trello cards as CSV, one row for every linked item,
+    sorted by board and list.'''
+    writer = csv.writer(stream)
+    writer.writerow(REPORT_FIELDS + ['item'])
+    for record in records:
+        row = [record[field] for field in REPORT_FIELDS]
+        row = [isinstance(value, unicode) and value.encode('utf-8') or value for value in row]
+        for nodeid in record['items']:
+            writer.writerow(row + [nodeid])
+
+
+REPORT_FIELDS = ['board', 'idList', 'list', 'url', 'id', 'name', 'status']
+REPORT_WRITERS = dict(text=write_text_report, json=write_json_report, csv=write_csv_report)
+
+
+class TrelloRegistry(object):
+    '''Session-scoped identity map of all trello cards, lists and boards.
+
+    Every entity is interned by id, so each card, list and board is retrieved
+    at most once per session regardless of how many tests reference it.  When
+    a TrelloSharedStore is provided, cards and lists are retrieved through
+    it, so concurrent processes on a host fetch each of them only once.
+    '''
+
+    def __init__(self, api, store=None):
+        self.api = api
+        self.store = store
+        self.cards = dict()
+        self.lists = dict()
+        self.boards = dict()
+        self._lock = threading.Lock()
+
+    def _intern(self, entities, cls, key):
+        with self._lock:
+            if key not in entities:
+                entities[key] = cls(self, key)
+            return entities[key]
+
+    def card(self, url):
+        '''Returns the card referenced by a card url, or id, interned by the
+        canonical card id (see card_id()).'''
+        card = self.cards.get(url)
+        if card is not None:
+            return card
+        return self._intern(self.cards, TrelloCard, card_id(url))
+
+    def fetch(self, kind, id, fetch):
+        '''Returns (data, fetched) of a card, list or board, from the shared
+        store or by calling fetch().'''
+        if self.store is None:
+            return (fetch(), time.time())
+        return self.store.fetch(kind, id, fetch)
+
+    def list(self, id):
+        return self._intern(self.lists, TrelloList, id)
+
+    def board(self, id):
+        return self._intern(self.boards, TrelloBoard, id)
+
+    def retain(self, ids):
+        '''Release all cards other than those of the provided ids.'''
+        with self._lock:
+            for id in list(self.cards):
+                if id not in ids:
+                    del self.cards[id]
+
+    def clear(self):
+        with self._lock:
+            self.cards.clear()
+            self.lists.clear()
+            self.boards.clear()
+
+    def dump(self):
+        '''Return a compact, JSON serializable snapshot of all resolved cards,
+        keyed by card id.'''
+        cards = dict()
+        for card in self.cards.values():
+            if card._card is None:
+                continue
+            lst = self.lists.get(card.idList)
+            cards[card.id] = dict(
+                name=card.name,
+                idList=card.idList,
+                list=(lst is not None and lst._list is not None) and lst._list['name'] or None,
+                closed=card._card.get('closed', False),
+                fetched=card.fetched,
+            )
+        return dict(version=SNAPSHOT_VERSION, cards=cards)
+
+    def load(self, snapshot):
+        '''Resolve all unresolved cards, and their lists, from a snapshot
+        previously returned by dump().'''
+        for card in self.cards.values():
+            entry = snapshot['cards'].get(card.id)
+            if card._card is not None or entry is None:
+                continue
+            card._card = dict(id=card.id, name=entry['name'], idList=entry['idList'], closed=entry['closed'])
+            card.fetched = entry['fetched']
+
+            if card.list._list is not None or entry['list'] is None:
+                continue
+            (card.list._list, card.list.fetched) = (dict(id=card.idList, name=entry['list']), entry['fetched'])
+
+
+def card_id(url):
+    '''Returns the id of the card referenced by a trello marker argument,
+    which may be a card url (with or without trailing slash, slug, query or
+    fragment) or a bare card id.'''
+    url = url.strip()
+    match = TRELLO_CARD_URL_RE.match(url)
+    if match is not None:
+        return match.group(1)
+    return os.path.basename(url.rstrip('/'))
+
+
+def batch_get(api, paths):
+    '''Issue GET requests of up to TRELLO_BATCH_SIZE api paths (e.g.
+    /cards/abc123?fields=name) as a single trello batch request.  Returns the
+    (status, data) of every path, in order.'''
+    # Commas separate the urls of a batch, so those within a url are escaped
+    urls = ','.join(path.replace(',', '%2C') for path in paths)
+    response = trello.cards.requests.get(TRELLO_API_URL + '/batch',
+                                         params=dict(key=api._apikey, token=api._token, urls=urls))
+    response.raise_for_status()
+    results = []
+    for entry in json.loads(response.content):
+        # Responses are keyed by their status, failures are an error object
+        (status, data) = list(entry.items())[0]
+        if len(entry) != 1 or not status.isdigit():
+            (status, data) = (entry.get('statusCode', 500), entry)
+        results.append((int(status), data))
+    if len(results) != len(paths):
+        raise ValueError("Expected %d batch responses, received %d" % (len(paths), len(results)))
+    return results
+
+
+def minimal(data, fields):
+    '''Returns the id, and provided fields, of a trello card or list.'''
+    return dict((key, value) for (key, value) in data.items() if key == 'id' or key in fields)
+
+
+def write_snapshot(path, snapshot):
+    '''Atomically write a snapshot returned by TrelloRegistry.dump() to path.'''
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as fd:
+        json.dump(snapshot, fd, separators=(',', ':'))
+    os.rename(tmp_path, path)
+
+
+def read_snapshot(path):
+    '''Read a snapshot previously written by write_snapshot().'''
+    with open(path, 'r') as fd:
+        snapshot = json.load(fd)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported trello snapshot version: %s" % snapshot.get('version'))
+    return snapshot
 
 
 class TrelloCard(object):
     '''Object representing a trello card.
     '''
 
-    def __init__(self, api, url):
-        self.api = api
-        self.url = url
+    __slots__ = ('registry', 'id', '_card', 'fetched', 'failed')
+
+    def __init__(self, registry, id):
+        self.registry = registry
+        self.id = id
         self._card = None
+        self.fetched = None
+        self.failed = False
+
+    @property
+    def api(self):
+        return self.registry.api
 
     @property
-    def id(self):
-        return os.path.basename(self.url)
+    def url(self):
+        return TRELLO_CARD_URL.format(self.id)
 
     @property
     def card(self):
-        if self._card is None:
+        if self._card is None and self.api is not None and not self.failed:
             try:
-                self._card = self.api.cards.get(self.id)
-            except ValueError, e:
+                (self._card, self.fetched) = self.registry.fetch('cards', self.id, lambda: minimal(
+                    self.api.cards.get(self.id, fields=','.join(TRELLO_CARD_FIELDS)), TRELLO_CARD_FIELDS))
+            except (ValueError, requests.exceptions.RequestException), e:
                 log.warning("Failed to retrieve card:%s - %s" % (self.id, e))
-                pass
+                self.failed = True
         return self._card
 
     @property
     def name(self):
+        if self.card is None:
+            return None
         return self.card['name']
 
     @property
     def idList(self):
+        if self.card is None:
+            return None
         return self.card['idList']
 
     @property
     def list(self):
-        return TrelloList(self.api, self.idList)
+        if self.idList is None:
+            return None
+        return self.registry.list(self.idList)
+
+    @property
+    def resolved(self):
+        '''Returns whether the card, and its list, are available.'''
+        return self.list is not None and self.list.name is not None
 
 
 class TrelloList(object):
     '''Object representing a trello list.
     '''
 
-    def __init__(self, api, id):
-        self.api = api
+    __slots__ = ('registry', 'id', '_list', 'fetched', 'failed')
+
+    def __init__(self, registry, id):
+        self.registry = registry
         self.id = id
         self._list = None
+        self.fetched = None
+        self.failed = False
+
+    @property
+    def api(self):
+        return self.registry.api
 
     @property
     def name(self):
-        if self._list is None:
+        if self._list is None and self.api is not None and not self.failed:
             try:
-                self._list = self.api.lists.get(self.id)
-            except ValueError, e:
+                (self._list, self.fetched) = self.registry.fetch('lists', self.id, lambda: minimal(
+                    self.api.lists.get(self.id, fields=','.join(TRELLO_LIST_FIELDS)), TRELLO_LIST_FIELDS))
+            except (ValueError, requests.exceptions.RequestException), e:
                 log.warning("Failed to retrieve list:%s - %s" % (self.id, e))
-                pass
+                self.failed = True
+        if self._list is None:
+            return None
         return self._list['name']
 
 
+class TrelloBoard(object):
+    '''Object recording when the cards and lists of a trello board were
+    fetched, or whether fetching them failed.
+    '''
+
+    __slots__ = ('registry', 'id', 'fetched', 'failed')
+
+    def __init__(self, registry, id):
+        self.registry = registry
+        self.id = id
+        self.fetched = None
+        self.failed = False
+
+
+def describe_card(card):
+    '''Returns a single line description of a card.'''
+    if not card.resolved:
+        return "{0} [unknown]".format(card.url)
+    return "{0} [{1}] {2}".format(card.url, card.list.name, card.name)
+
+
 class TrelloCardList(object):
-    '''Object representing a list of trello cards.'''
-    def __init__(self, api, *cards, **kwargs):
-        self.api = api
+    '''Object representing a list of trello cards.  Once the cards are
+    resolved, reason holds why linked items are xfailed (or skipped), or None
+    when all cards are complete.'''
+
+    __slots__ = ('registry', 'cards', 'xfail', 'reason')
+
+    def __init__(self, registry, *cards, **kwargs):
+        self.registry = registry
         self.cards = cards
         self.xfail = kwargs.get('xfail', True) and not ('skip' in kwargs)
+        self.reason = None
 
     def __iter__(self):
         for card in self.cards:
-            if card not in _card_cache:
-                _card_cache[card] = TrelloCard(self.api, card)
-            yield _card_cache[card]
+            yield self.registry.card(card)
+
+
+class TrelloSharedSnapshot(object):
+    '''Snapshot of resolved cards shared by all pytest-xdist workers.
+
+    The first worker to claim the snapshot resolves its cards and writes the
+    snapshot.  All other workers wait for, and load, that snapshot instead of
+    contacting trello themselves.
+    '''
+
+    def __init__(self, path, timeout=DEFAULT_TRELLO_SNAPSHOT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+
+    def claim(self):
+        '''Returns True if the calling process is responsible for writing the
+        snapshot.'''
+        try:
+            os.close(os.open(self.path + '.lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+
+    def write(self, snapshot):
+        write_snapshot(self.path, snapshot)
+
+    def read(self):
+        '''Wait for, and return, the snapshot.  Returns None if the snapshot
+        was not written within the configured timeout.'''
+        expires = time.time() + self.timeout
+        while not os.path.isfile(self.path):
+            if time.time() > expires:
+                log.warning("Timed out waiting for trello snapshot: %s" % self.path)
+                return None
+            time.sleep(0.1)
+        return read_snapshot(self.path)
+
+
+class TrelloXdistPlugin(object):
+    '''Provides each pytest-xdist worker with the location of a shared
+    snapshot, so trello cards are resolved once for the entire run.'''
+
+    def __init__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pytest-trello-')
+        self.path = os.path.join(self.tmpdir, 'snapshot.json')
+
+    def pytest_configure_node(self, node):
+        workerinput = getattr(node, 'workerinput', None)
+        if workerinput is None:
+            workerinput = node.slaveinput
+        workerinput['trello_snapshot'] = self.path
+
+    def snapshot(self):
+        '''Returns the snapshot shared by the workers, or None when no worker
+        resolved any cards.'''
+        if not os.path.isfile(self.path):
+            return None
+        return read_snapshot(self.path)
+
+    def pytest_testnodedown(self, node, error):
+        workeroutput = getattr(node, 'workeroutput', getattr(node, 'slaveoutput', {}))
+        if 'trello_metrics' in workeroutput:
+            activate(node.config).metrics.merge(workeroutput['trello_metrics'])
+
+    def pytest_unconfigure(self, config):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
 
 
 class TrelloPytestPlugin(object):
     def __init__(self, api, **kwargs):
         log.debug("TrelloPytestPlugin initialized")
+        import_dependencies()
         self.api = api
+        self.registry = TrelloRegistry(api, kwargs.get('store', None))
         self.completed_lists = kwargs.get('completed_lists', [])
+        self.workers = max(1, kwargs.get('workers', DEFAULT_TRELLO_WORKERS))
+        self.resolver = kwargs.get('resolver', 'card')
+        self.cache = kwargs.get('cache', None)
+        self.cache_ttl = kwargs.get('cache_ttl', DEFAULT_TRELLO_CACHE_TTL)
+        self.cache_max_cards = kwargs.get('cache_max_cards', 0)
+        self.sync = kwargs.get('sync', False)
+        self.stale_ok = kwargs.get('stale_ok', False)
+        if self.stale_ok and not self.cache_ttl:
+            # Cards younger than this are used as they are, without a refresh
+            self.cache_ttl = DEFAULT_TRELLO_STALE_TTL
+        self._revalidation = None
+        self._refreshed = []
+        self._prefetching = None
+        self._previous = []
+        self.daemon = kwargs.get('daemon', None)
+        self.session = kwargs.get('session', None)
+        self.metrics = kwargs.get('metrics', None) or TrelloMetrics()
+        self.metrics_json = kwargs.get('metrics_json', None)
+        self.fallback = kwargs.get('fallback', 'complete')
+        self.snapshot = kwargs.get('snapshot', None)
+        self.snapshot_read = kwargs.get('snapshot_read', None)
+        self.snapshot_write = kwargs.get('snapshot_write', None)
+        self.card_items = dict()
+
+    def _fetch(self, obj):
+        '''Resolve a single card or list.  Any errors are logged, and
+        remembered, by the card or list itself.'''
+        if isinstance(obj, TrelloCard):
+            obj.card
+        else:
+            obj.name
+
+    def prefetch(self, cards):
+        '''Resolve all provided cards, followed by their lists, using a pool of
+        worker threads.  Subsequent access to card and list attributes is
+        answered from memory.'''
+        cards = [card for card in cards if card._card is None]
+        if not cards:
+            return
+
+        if self.snapshot_read is not None:
+            self.registry.load(self.snapshot_read)
+        elif self.snapshot is None:
+            self._prefetch(cards)
+        elif self.snapshot.claim():
+            try:
+                self._prefetch(cards)
+            finally:
+                self.snapshot.write(self.registry.dump())
+        else:
+            snapshot = self.snapshot.read()
+            if snapshot is not None:
+                self.registry.load(snapshot)
+            self._prefetch([card for card in cards if card._card is None])
+
+    def _prefetch(self, cards):
+        if not cards:
+            return
+
+        # Ask a running pytest-trello-daemon first, quietly falling back to trello
+        if self.daemon is not None:
+            snapshot = query_daemon(os.path.expanduser(self.daemon), [card.id for card in cards])
+            if snapshot is not None:
+                self.registry.load(snapshot)
+
+        if self.use_cache and self.sync:
+            TrelloSync(self.api, self.cache).sync()
+        pending = [card for card in cards if card._card is None]
+        if self.use_cache:
+            self._load_cache(pending, self.cache_ttl)
+            hits = len(pending)
+            pending = [card for card in pending if card._card is None]
+            self.metrics.record_cache(hits - len(pending), len(pending))
+        if self.registry.store is not None:
+            self._load_store(pending)
+            pending = [card for card in pending if card._card is None]
+        if self.stale_ok and self.cache is not None:
+            # Only cards never seen before are fetched before the run, while
+            # cards older than cache_ttl are refreshed in the background
+            self._load_cache(pending)
+            self._revalidate([card for card in pending if card._card is not None])
+            pending = [card for card in pending if card._card is None]
+
+        # Starting, and joining, a pool costs ~0.1s, so only do so when needed
+        if not pending and all(card.list._list is not None for card in cards if card._card is not None):
+            return
+
+        pool = ThreadPool(min(self.workers, len(cards)))
+        try:
+            if pending and self.resolver == 'board':
+                self._prefetch_boards(pool, pending)
+                pending = []
+            if pending and self.resolver == 'batch' and self.api is not None:
+                pending = self._prefetch_batch(pool, pending)
+            if pending:
+                self._prefetch_cards(pool, pending)
+
+            # Resolve any lists not already resolved along with their cards
+            lists = set(card.list for card in cards if card._card is not None)
+            pool.map(self._fetch, [lst for lst in lists if lst._list is None])
+        finally:
+            pool.close()
+            pool.join()
+
+    def prefetch_previous(self, card_ids):
+        '''Start resolving the cards collected by the previous session on a
+        background thread, while items are collected.  Cards that are no
+        longer referenced are released once collection finishes.'''
+        self._previous = card_ids
+        cards = [self.registry.card(card_id) for card_id in card_ids]
+
+        def prefetch():
+            try:
+                self.prefetch(cards)
+            except Exception, e:
+                log.warning("Failed to prefetch trello cards of the previous session - %s" % e)
+
+        log.debug("Prefetching %d trello cards of the previous session" % len(cards))
+        self._prefetching = threading.Thread(target=prefetch, name='trello-prefetch')
+        self._prefetching.daemon = True
+        self._prefetching.start()
+
+    def _revalidate(self, cards):
+        '''Refresh stale cards, and their lists, on a background thread while
+        the session runs.  Items keep the verdicts of the stale cards, while
+        each refreshed card is queued for the cache as soon as it arrives, so
+        it is saved for the next session even when the session ends before
+        all cards were refreshed.'''
+        if not cards:
+            return
+
+        def refresh():
+            registry = TrelloRegistry(self.api, self.registry.store)
+            fresh = [registry.card(card.id) for card in cards]
+            pool = ThreadPool(min(self.workers, len(fresh)))
+            try:
+                self._prefetch_cards(pool, fresh, self._refreshed.append)
+            finally:
+                pool.close()
+                pool.join()
+
+        log.debug("Refreshing %d stale trello cards in the background" % len(cards))
+        self._revalidation = threading.Thread(target=refresh, name='trello-revalidate')
+        self._revalidation.daemon = True
+        self._revalidation.start()
+
+    def _prefetch_cards(self, pool, cards, done=None):
+        '''Resolve cards on the pool.  Each worker resolves the list of a card
+        as soon as the card arrives (unless another worker already claimed
+        it), so card and list lookups are pipelined instead of waiting for
+        the slowest card before any list is requested.  When provided, done
+        is called with every card resolved.'''
+        claimed = set()
+        lock = threading.Lock()
+
+        def fetch(card):
+            self._fetch(card)
+            if card._card is None:
+                return
+            lst = card.list
+            with lock:
+                fetch_list = lst._list is None and lst.id not in claimed
+                claimed.add(lst.id)
+            if fetch_list:
+                self._fetch(lst)
+            if done is not None:
+                done(card)
+
+        pool.map(fetch, cards)
+
+    def _prefetch_batch(self, pool, cards):
+        '''Resolve cards, followed by their lists, using batch requests on
+        the pool.  Returns the cards that need to be fetched individually.'''
+        def batches(entities):
+            return [entities[i:i + TRELLO_BATCH_SIZE] for i in range(0, len(entities), TRELLO_BATCH_SIZE)]
+
+        pending = []
+        for retry in pool.map(lambda batch: self._fetch_batch('cards', batch), batches(cards)):
+            pending.extend(retry)
+        lists = set(card.list for card in cards if card._card is not None)
+        pool.map(lambda batch: self._fetch_batch('lists', batch),
+                 batches([lst for lst in lists if lst._list is None and not lst.failed]))
+        return pending
+
+    def _fetch_batch(self, kind, entities):
+        '''Resolve up to TRELLO_BATCH_SIZE cards, or lists, in a single batch
+        request.  Entries that failed within the batch are handled one by
+        one: those trello could not find are remembered as failed, while any
+        others (e.g. rate limited) are returned to be fetched individually,
+        along with all entities of a batch that failed altogether.  With a
+        shared store, entities another process is already fetching are left
+        out of the batch, and returned to wait for that process.'''
+        (fields, attr) = kind == 'cards' and (TRELLO_CARD_FIELDS, '_card') or (TRELLO_LIST_FIELDS, '_list')
+        store = self.registry.store
+        if store is None:
+            return self._fetch_claimed_batch(kind, entities, fields, attr)
+
+        claimed = set(store.claim(kind, [entity.id for entity in entities]))
+        try:
+            return (self._fetch_claimed_batch(kind, [entity for entity in entities if entity.id in claimed], fields, attr) +
+                    [entity for entity in entities if entity.id not in claimed])
+        finally:
+            store.release(kind, claimed)
+
+    def _fetch_claimed_batch(self, kind, entities, fields, attr):
+        if not entities:
+            return []
+        try:
+            results = batch_get(self.api, ['/%s/%s?fields=%s' % (kind, entity.id, ','.join(fields))
+                                           for entity in entities])
+        except (ValueError, requests.exceptions.RequestException), e:
+            log.warning("Failed to retrieve %s batch - %s" % (kind, e))
+            return entities
+
+        now = time.time()
+        retry = []
+        resolved = dict()
+        for (entity, (status, data)) in zip(entities, results):
+            if status == 200:
+                resolved[entity.id] = (minimal(data, fields), now)
+                setattr(entity, attr, resolved[entity.id][0])
+                entity.fetched = now
+            elif status < 500 and status != 429:
+                log.warning("Failed to retrieve %s:%s - HTTP %s" % (kind[:-1], entity.id, status))
+                entity.failed = True
+            else:
+                retry.append(entity)
+
+        # Share the batch with other processes
+        if self.registry.store is not None and resolved:
+            self.registry.store.store(kind, resolved)
+        return retry
+
+    @property
+    def use_cache(self):
+        return self.cache is not None and self.cache_ttl > 0
+
+    @property
+    def save_cache(self):
+        return self.use_cache or (self.cache is not None and (self.fallback == 'cached' or self.stale_ok))
+
+    def _load_cache(self, cards, max_age=None):
+        '''Resolve cards, and their lists, from the pytest cache when they were
+        fetched within the last max_age seconds (or regardless of their age
+        when max_age is None).'''
+        expires = 0
+        if max_age is not None:
+            expires = time.time() - max_age
+        cached_cards = self.cache.get('trello/cards', {})
+        cached_lists = self.cache.get('trello/lists', {})
+        for card in cards:
+            entry = cached_cards.get(card.id)
+            if entry is None or entry['fetched'] < expires:
+                continue
+            (card._card, card.fetched) = (entry['card'], entry['fetched'])
+
+            entry = cached_lists.get(card.idList)
+            if card.list._list is not None or entry is None or entry['fetched'] < expires:
+                continue
+            (card.list._list, card.list.fetched) = (entry['list'], entry['fetched'])
+
+    def _load_store(self, cards):
+        '''Resolve cards, and their lists, from the shared store using a
+        single query for each.'''
+        store = self.registry.store
+        cards_by_id = dict((card.id, card) for card in cards)
+        for (id, (data, fetched)) in store.load('cards', cards_by_id.keys()).items():
+            (cards_by_id[id]._card, cards_by_id[id].fetched) = (data, fetched)
+        lists = set(card.list for card in cards if card._card is not None and card.list._list is None)
+        for (id, (data, fetched)) in store.load('lists', [lst.id for lst in lists]).items():
+            (self.registry.lists[id]._list, self.registry.lists[id].fetched) = (data, fetched)
+
+    def _save_cache(self):
+        '''Store all cards and lists resolved during this session in the
+        pytest cache, discarding any expired entries (unless they are needed
+        by the cached fallback policy, or --trello-stale-ok).  When cache_max_cards is set, only the
+        most recently used cards, and their lists, are kept.'''
+        now = time.time()
+        expires = now - self.cache_ttl
+        cached_cards = self.cache.get('trello/cards', {})
+        cached_lists = self.cache.get('trello/lists', {})
+        for card in self.registry.cards.values():
+            if card._card is not None and card.fetched is not None:
+                cached_cards[card.id] = dict(card=card._card, fetched=card.fetched, used=now)
+        for lst in self.registry.lists.values():
+            if lst._list is not None and lst.fetched is not None:
+                cached_lists[lst.id] = dict(list=lst._list, fetched=lst.fetched)
+        # Cards refreshed in the background so far, by --trello-stale-ok
+        for card in list(self._refreshed):
+            cached_cards[card.id] = dict(card=card._card, fetched=card.fetched, used=now)
+            lst = card.list
+            if lst._list is not None and lst.fetched is not None:
+                cached_lists[lst.id] = dict(list=lst._list, fetched=lst.fetched)
+
+        for cached in (cached_cards, cached_lists):
+            for (key, entry) in list(cached.items()):
+                if entry['fetched'] < expires and not (self.fallback == 'cached' or self.stale_ok):
+                    del cached[key]
+
+        if self.cache_max_cards and len(cached_cards) > self.cache_max_cards:
+            by_use = sorted(cached_cards.items(), key=lambda item: item[1].get('used', item[1]['fetched']), reverse=True)
+            cached_cards = dict(by_use[:self.cache_max_cards])
+            used_lists = set(entry['card'].get('idList') for entry in cached_cards.values())
+            cached_lists = dict((key, entry) for (key, entry) in cached_lists.items() if key in used_lists)
+        self.cache.set('trello/cards', cached_cards)
+        self.cache.set('trello/lists', cached_lists)
+
+    def _prefetch_boards(self, pool, cards):
+        '''Resolve cards by fetching all cards and lists of their boards.
+
+        Boards are discovered by fetching pending cards on the pool, in waves
+        of one card, then twice as many each wave (up to the number of
+        workers), so a single board costs a single card lookup.  Every other
+        pending card found on a discovered board is resolved from the board
+        payload.  Cards missing from the board payload (e.g. archived cards),
+        or on boards that failed to be retrieved, are resolved individually
+        when they are reached.'''
+        pending = dict((card.id, card) for card in cards)
+        size = 1
+        while pending:
+            wave = [pending.pop(card_id) for card_id in list(pending)[:size]]
+            size = min(size * 2, self.workers)
+            pool.map(self._fetch, wave)
+
+            boards = set(self.registry.board(card.card['idBoard']) for card in wave
+                         if card._card is not None and card.card.get('idBoard') is not None)
+            boards = [board for board in boards if board.fetched is None and not board.failed]
+            for (board, payload) in zip(boards, pool.map(self._fetch_board, boards)):
+                if payload is None:
+                    continue
+                (board_cards, board_lists) = payload
+                for data in board_lists:
+                    lst = self.registry.list(data['id'])
+                    (lst._list, lst.fetched) = (data, board.fetched)
+                for data in board_cards:
+                    for key in (data.get('shortLink'), data.get('id')):
+                        if key in pending:
+                            card = pending.pop(key)
+                            (card._card, card.fetched) = (data, board.fetched)
+
+    def _fetch_board(self, board):
+        '''Returns the cards and lists of a board, or None when the board could
+        not be retrieved, which is remembered so it is not requested again.
+        With a shared store, a board is fetched by a single process, and its
+        cards and lists are shared with other processes.'''
+        def fetch():
+            board_cards = [minimal(data, TRELLO_CARD_FIELDS) for data in
+                           self.api.boards.get_card(board.id, fields=','.join(TRELLO_CARD_FIELDS))]
+            board_lists = [minimal(data, TRELLO_LIST_FIELDS) for data in
+                           self.api.boards.get_list(board.id, filter='all', fields=','.join(TRELLO_LIST_FIELDS))]
+            if self.registry.store is not None:
+                now = time.time()
+                self.registry.store.store('lists', dict((data['id'], (data, now)) for data in board_lists))
+                self.registry.store.store('cards', dict(
+                    (data.get('shortLink', data['id']), (data, now)) for data in board_cards))
+            return dict(cards=board_cards, lists=board_lists)
+
+        try:
+            (payload, board.fetched) = self.registry.fetch('boards', board.id, fetch)
+        except (requests.exceptions.RequestException, ValueError), e:
+            log.warning("Failed to retrieve board:%s - %s" % (board.id, e))
+            board.failed = True
+            return None
+        return (payload['cards'], payload['lists'])
+
+    def report(self):
+        '''Returns a record describing every collected card, and the ids of
+        its items, sorted by board, list and url.'''
+        records = []
+        for (id, nodeids) in self.card_items.items():
+            card = self.registry.card(id)
+            record = dict(url=card.url, id=card.id, name=None, board=None, idList=None, list=None,
+                          status='unknown', items=nodeids)
+            if card.resolved:
+                record.update(name=card.name, board=card.card.get('idBoard'), idList=card.idList, list=card.list.name,
+                              status=card.list.name in self.completed_lists and 'complete' or 'incomplete')
+            records.append(record)
+        records.sort(key=lambda record: (record['board'] or '', record['list'] or '', record['idList'] or '', record['url']))
+        return records
 
     def pytest_runtest_setup(self, item):
         log.debug("pytest_runtest_setup() called")
         if 'trello' not in item.keywords:
             return
 
-        incomplete_cards = []
+        with self.metrics.timed('pytest_runtest_setup'):
+            self._runtest_setup(item)
+
+    def _runtest_setup(self, item):
         cards = item.funcargs["cards"]
-        for card in cards:
-            try:
-                if card.list.name not in self.completed_lists:
-                    incomplete_cards.append(card)
-            except requests.exceptions.HTTPError, e:
-                log.warning("Error accessing card:%s - %s" % (card.id, e))
-                continue
+        if cards.reason is None:
+            return
+        if cards.xfail:
+            item.add_marker(pytest.mark.xfail(reason=cards.reason))
+        else:
+            pytest.skip(cards.reason)
 
-        # item.get_marker('trello').kwargs
-        if incomplete_cards:
-            if cards.xfail:
-                item.add_marker(pytest.mark.xfail(
-                    reason="Xfailing due to incomplete trello cards: \n{0}".format(
-                        "\n ".join(["{0} [{1}] {2}".format(card.url, card.list.name, card.name) for card in incomplete_cards]))))
-            else:
-                pytest.skip("Skipping due to incomplete trello cards:\n{0}".format(
-                    "\n ".join(["{0} [{1}] {2}".format(card.url, card.list.name, card.name) for card in incomplete_cards])))
-
-    def pytest_collection_modifyitems(self, session, config, items):
-        log.debug("pytest_collection_modifyitems() called")
-        reporter = config.pluginmanager.getplugin("terminalreporter")
-        reporter.write("collected", bold=True)
-        for i, item in enumerate(filter(lambda i: i.get_marker("trello") is not None, items)):
+    def verdict(self, cards):
+        '''Returns the reason to xfail (or skip) items linked to the provided
+        cards, or None when all cards are complete.'''
+        incomplete_cards = [card for card in cards if not self.is_complete(card)]
+        if not incomplete_cards:
+            return None
+        if cards.xfail:
+            return "Xfailing due to incomplete trello cards: \n{0}".format(
+                "\n ".join([describe_card(card) for card in incomplete_cards]))
+        return "Skipping due to incomplete trello cards:\n{0}".format(
+            "\n ".join([describe_card(card) for card in incomplete_cards]))
+
+    def is_complete(self, card):
+        '''Returns whether the card is in one of the completed lists.  Cards
+        that cannot be resolved are handled according to the fallback
+        policy.'''
+        if not card.resolved and self.fallback == 'cached' and self.cache is not None:
+            self._load_cache([card])
+        if card.resolved:
+            return card.list.name in self.completed_lists
+
+        log.warning("Unable to resolve card:%s, treating as %s" % (card.id, self.fallback == 'incomplete' and 'incomplete' or 'complete'))
+        return self.fallback != 'incomplete'
+
+    def collection_finish(self, session):
+        '''Register, and resolve, the cards of all selected items.  This runs
+        from pytest_collection_finish, after every
+        pytest_collection_modifyitems hook, so items deselected by -k, -m,
+        --lf, etc. are not considered.'''
+        log.debug("pytest_collection_finish() called")
+        with self.metrics.timed('pytest_collection_finish'):
+            self._collection_finish(session)
+
+    def _collection_finish(self, session):
+        reporter = session.config.pluginmanager.getplugin("terminalreporter")
+        # Items linked to the same cards share a single TrelloCardList
+        card_lists = dict()
+        self.card_items = dict()
+        for i, item in enumerate(filter(lambda i: i.get_marker("trello") is not None, session.items)):
             marker = item.get_marker('trello')
-            cards = tuple(sorted(set(marker.args)))  # (O_O) for caching
+            # Card urls are parsed once, so every spelling of a card shares it
+            cards = tuple(sorted(set(card_id(url) for url in marker.args)))  # (O_O) for caching
+            card_list = TrelloCardList(self.registry, *cards, **marker.kwargs)
+            if (cards, card_list.xfail) not in card_lists:
+                for card in cards:
+                    self.registry.card(card)
+                card_lists[(cards, card_list.xfail)] = card_list
+            item.funcargs["cards"] = card_lists[(cards, card_list.xfail)]
             for card in cards:
-                if card not in _card_cache:
-                    _card_cache[card] = TrelloCard(self.api, card)
-            item.funcargs["cards"] = TrelloCardList(self.api, *cards, **marker.kwargs)
-        reporter.write(" {0} trello markers\n".format(len(_card_cache)), bold=True)
+                self.card_items.setdefault(card, []).append(item.nodeid)
+
+        # Only wait for the cards of the previous session when a selected item
+        # references one of them, otherwise leave the daemon thread behind
+        if self._prefetching is not None:
+            if set(self.card_items).intersection(self._previous):
+                self._prefetching.join()
+            self._prefetching = None
+
+        # Release cards of the previous session that are no longer referenced,
+        # and remember the cards of this one for the next
+        if self._previous:
+            self.registry.retain(self.card_items)
+        card_ids = sorted(self.card_items)
+        if self.cache is not None and self.snapshot is None and card_ids != self._previous:
+            self.cache.set(collected_key(session.config), card_ids)
+
+        # pytest-xdist workers have no terminal reporter
+        if reporter is not None:
+            reporter.write("collected {0} trello markers\n".format(len(self.registry.cards)), bold=True)
+
+        self.prefetch(self.registry.cards.values())
+
+        # Decide once per unique set of cards, rather than for every item
+        for card_list in card_lists.values():
+            card_list.reason = self.verdict(card_list)
+
+    def pytest_sessionfinish(self, session):
+        log.debug("pytest_sessionfinish() called")
+        if self._prefetching is not None:
+            self._prefetching.join(DEFAULT_TRELLO_REVALIDATE_TIMEOUT)
+        # Briefly wait for stale cards to be refreshed, so they are saved.
+        # Cards still being refreshed are saved by a later session.
+        if self._revalidation is not None:
+            self._revalidation.join(DEFAULT_TRELLO_REVALIDATE_TIMEOUT)
+        if self.save_cache:
+            self._save_cache()
+
+        # Hand metrics to the pytest-xdist controller
+        workeroutput = getattr(session.config, 'workeroutput', getattr(session.config, 'slaveoutput', None))
+        if workeroutput is not None:
+            workeroutput['trello_metrics'] = self.metrics.dump()
+
+        # pytest-xdist workers leave the snapshot to the controller, which
+        # never collects, and writes the snapshot the workers shared instead
+        if self.snapshot_write is not None and workeroutput is None:
+            trello_xdist = session.config.pluginmanager.getplugin('trello_xdist')
+            snapshot = trello_xdist is not None and trello_xdist.snapshot() or None
+            write_snapshot(self.snapshot_write, snapshot or self.registry.dump())
+
+    def pytest_terminal_summary(self, terminalreporter):
+        metrics = self.metrics.summary()
+        if not (self.registry.cards or metrics['total_requests'] or 'pytest_runtest_setup' in metrics['hooks']):
+            return
+
+        terminalreporter.section("trello metrics")
+        terminalreporter.write_line("requests: {0} ({1}), retries: {2}, errors: {3}".format(
+            metrics['total_requests'],
+            ", ".join(["{0}: {1}".format(name, count) for (name, count) in sorted(metrics['requests'].items())]),
+            metrics['retries'], metrics['errors']))
+        terminalreporter.write_line("latency: p50 {p50:.3f}s, p95 {p95:.3f}s, max {max:.3f}s".format(**metrics['latency']))
+        terminalreporter.write_line("rate limiter: max queue depth {max_queue_depth}, throttled {throttled:.3f}s, "
+                                    "{rate_limited} rate limited responses".format(**metrics))
+        terminalreporter.write_line("cache: {0} hits, {1} misses".format(metrics['cache_hits'], metrics['cache_misses']))
+        terminalreporter.write_line("hooks: {0}".format(
+            ", ".join(["{0} {1:.3f}s".format(name, elapsed) for (name, elapsed) in sorted(metrics['hooks'].items())])))
+
+    def pytest_unconfigure(self, config):
+        if self.session is not None:
+            self.session.close()
+        if self.registry.store is not None:
+            self.registry.store.close()
+        # Release all cards, so repeated in-process sessions don't accumulate them
+        self.registry.clear()
+        self.card_items.clear()
+        if self.metrics_json is not None:
+            with open(self.metrics_json, 'w') as fd:
+                json.dump(self.metrics.summary(), fd, indent=2)
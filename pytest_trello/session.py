@@ -0,0 +1,307 @@
+import time
+import logging
+import threading
+import requests
+import requests.adapters
+import requests.exceptions
+import trello
+from pytest_trello.metrics import endpoint
+from pytest_trello.defaults import TRELLO_API_URL, DEFAULT_TRELLO_POOL_SIZE, DEFAULT_TRELLO_RETRIES, \
+    DEFAULT_TRELLO_BACKOFF, DEFAULT_TRELLO_RATE, DEFAULT_TRELLO_TIMEOUT, DEFAULT_TRELLO_MAX_FAILURES
+
+try:
+    from logging import NullHandler
+except ImportError:
+    from logging import Handler
+    class NullHandler(Handler):
+        def emit(self, record):
+            pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+"""
+pytest-trello
+~~~~~~~~~~~~
+
+HTTP session shared by every trello request made by the plugin.
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+
+# trello modules whose requests are routed through the session
+TRELLO_MODULES = (trello.actions, trello.boards, trello.cards, trello.lists)
+
+
+class TokenBucket(object):
+    '''Thread-safe token bucket limiting the rate of trello requests.
+
+    The rate is halved whenever trello responds with 429, and requests are
+    paused for any Retry-After period.  The rate then gradually recovers
+    with every successful response.  The number of threads waiting for a
+    token (waiting, max_waiting), the total time spent waiting (throttled)
+    and the number of 429 responses (limited) are recorded, and reported to
+    metrics when provided.  When a timeout is provided, acquire() gives up
+    after waiting that many seconds.
+    '''
+
+    def __init__(self, rate=DEFAULT_TRELLO_RATE, burst=None, metrics=None):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.paused_until = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.throttled = 0.0
+        self.limited = 0
+        self.metrics = metrics
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        '''Block until a request may be issued, and return True, or return
+        False after waiting timeout seconds.'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            if self.metrics is not None:
+                self.metrics.record_queue_depth(self.waiting)
+        try:
+            while True:
+                with self._lock:
+                    now = time.time()
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    delay = self.paused_until - now
+                    if delay <= 0:
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            return True
+                        delay = (1 - self.tokens) / self.rate
+                    if deadline is not None and now + delay > deadline:
+                        delay = deadline - now
+                        if delay <= 0:
+                            return False
+                    self.throttled += delay
+                if self.metrics is not None:
+                    self.metrics.record_throttle(delay)
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def throttle(self, retry_after=None):
+        '''Slow down after trello responded with 429.'''
+        with self._lock:
+            self.limited += 1
+            if self.metrics is not None:
+                self.metrics.record_throttle(limited=True)
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.time() + retry_after)
+
+    def recover(self):
+        '''Speed up again after a successful response.'''
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class TrelloUnavailable(requests.exceptions.RequestException):
+    '''Raised instead of contacting trello once the circuit breaker is open.'''
+
+
+class CircuitBreaker(object):
+    '''Stops all trello requests after max_failures consecutive failures, or
+    once budget seconds (of wall-clock time) passed since the first request.'''
+
+    def __init__(self, max_failures=DEFAULT_TRELLO_MAX_FAILURES, budget=None):
+        self.max_failures = max_failures
+        self.budget = budget
+        self.failures = 0
+        self.started = None
+        self.reason = None
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self.reason is not None
+
+    def check(self):
+        '''Raise TrelloUnavailable if trello must not be contacted.'''
+        with self._lock:
+            if self.started is None:
+                self.started = time.time()
+            self._check_budget()
+        if self.reason is not None:
+            raise TrelloUnavailable("Not contacting trello - %s" % self.reason)
+
+    def remaining(self):
+        '''Returns the number of seconds left in the time budget, or None
+        without a budget.'''
+        if self.budget is None or self.started is None:
+            return None
+        return max(0.0, self.budget - (time.time() - self.started))
+
+    def _check_budget(self):
+        if self.reason is None and self.budget is not None and time.time() - self.started >= self.budget:
+            self.reason = "time budget of %ss exhausted" % self.budget
+            log.warning("Trello circuit breaker open: %s" % self.reason)
+
+    def record(self, success):
+        '''Record the outcome of a single request.'''
+        with self._lock:
+            if success:
+                self.failures = 0
+            else:
+                self.failures += 1
+
+            if self.reason is not None:
+                return
+            if self.max_failures and self.failures >= self.max_failures:
+                self.reason = "%d consecutive failed requests" % self.failures
+                log.warning("Trello circuit breaker open: %s" % self.reason)
+
+
+def retry_after(response):
+    '''Returns the number of seconds requested by a Retry-After header, or None.'''
+    try:
+        return max(0.0, float(response.headers['Retry-After']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class TrelloSession(object):
+    '''Pooled, keep-alive HTTP session with retries.
+
+    The trello library issues every request with the module level
+    requests.get(), which opens a new connection each time.  Once installed,
+    a TrelloSession stands in for the requests module of the trello library
+    modules, so that all requests share a connection pool.  Connection
+    errors, 5xx and 429 responses are retried with exponential backoff.  When
+    a limiter is provided, every request first waits for a token.  When a
+    breaker is provided, requests fail immediately once it is open.  When a
+    base_url is provided, requests are sent there instead of TRELLO_API_URL.
+    When metrics are provided, every request and retry is recorded.
+
+    The breaker is checked before every attempt, and the timeout of every
+    attempt, the backoff between attempts and the wait for the limiter are
+    all cut short to the remaining time budget of the breaker.
+    '''
+
+    def __init__(self, pool_size=DEFAULT_TRELLO_POOL_SIZE, retries=DEFAULT_TRELLO_RETRIES,
+                 backoff=DEFAULT_TRELLO_BACKOFF, timeout=DEFAULT_TRELLO_TIMEOUT,
+                 limiter=None, breaker=None, metrics=None, base_url=TRELLO_API_URL):
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = limiter
+        self.breaker = breaker
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._installed = dict()
+
+    def __getattr__(self, name):
+        # Anything other than get() is served by the requests module
+        return getattr(requests, name)
+
+    def get(self, url, **kwargs):
+        if url.startswith(TRELLO_API_URL):
+            url = self.base_url + url[len(TRELLO_API_URL):]
+        kwargs.setdefault('timeout', self.timeout)
+        if self.breaker is not None:
+            self.breaker.check()
+
+        # Time spent on the wire, leaving out limiter and backoff waits
+        elapsed = [0.0]
+        response = None
+        try:
+            response = self._get(url, elapsed, **kwargs)
+            return response
+        finally:
+            if self.breaker is not None:
+                self.breaker.record(response is not None and response.status_code < 500 and response.status_code != 429)
+            if self.metrics is not None:
+                path = url[len(self.base_url):].split('?', 1)[0]
+                self.metrics.record_request(endpoint(path), elapsed[0], response is None or response.status_code >= 400)
+
+    def _get(self, url, elapsed, **kwargs):
+        '''Issue a request, with retries, adding the duration of every attempt
+        to elapsed[0].'''
+        timeout = kwargs.pop('timeout')
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(self._remaining())
+            if self.breaker is not None:
+                self.breaker.check()
+            attempt_timeout = timeout
+            remaining = self._remaining()
+            if remaining is not None:
+                attempt_timeout = remaining if timeout is None else min(timeout, remaining)
+            delay = self.backoff * (2 ** attempt)
+            start = time.time()
+            try:
+                response = self.session.get(url, timeout=attempt_timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                elapsed[0] += time.time() - start
+                if attempt >= self.retries:
+                    raise
+                log.debug("Retrying %s - %s" % (url, e))
+            else:
+                elapsed[0] += time.time() - start
+                if response.status_code == 429:
+                    seconds = retry_after(response)
+                    if self.limiter is not None:
+                        self.limiter.throttle(seconds)
+                        # The limiter waits for Retry-After before the next request
+                        if seconds is not None:
+                            delay = 0
+                    elif seconds is not None:
+                        delay = seconds
+                elif response.status_code < 500:
+                    if self.limiter is not None:
+                        self.limiter.recover()
+                    return response
+                if attempt >= self.retries:
+                    return response
+                log.debug("Retrying %s - HTTP %s" % (url, response.status_code))
+            if self.metrics is not None:
+                self.metrics.record_retry()
+            remaining = self._remaining()
+            if remaining is not None:
+                delay = min(delay, remaining)
+            if delay:
+                time.sleep(delay)
+            attempt += 1
+
+    def _remaining(self):
+        '''Returns the number of seconds left in the time budget, or None.'''
+        if self.breaker is not None:
+            return self.breaker.remaining()
+        return None
+
+    def install(self):
+        '''Route all requests of the trello library through this session.'''
+        for module in TRELLO_MODULES:
+            self._installed[module] = module.requests
+            module.requests = self
+
+    def uninstall(self):
+        '''Restore the trello library to its original requests module.'''
+        for (module, original) in self._installed.items():
+            module.requests = original
+        self._installed.clear()
+
+    def close(self):
+        self.uninstall()
+        self.session.close()
+        if self.limiter is not None:
+            log.info("Trello rate limiter: max queue depth %d, throttled %.2fs, %d rate limited responses" %
+                     (self.limiter.max_waiting, self.limiter.throttled, self.limiter.limited))
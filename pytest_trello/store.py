@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pytest_trello.defaults import DEFAULT_TRELLO_SHARED_CACHE_TTL
+
+try:
+    from logging import NullHandler
+except ImportError:
+    from logging import Handler
+    class NullHandler(Handler):
+        def emit(self, record):
+            pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+"""
+pytest-trello
+~~~~~~~~~~~~
+
+Host-wide store of trello cards and lists, shared by concurrent pytest
+processes across checkouts and virtualenvs.
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+
+# Seconds after which the claim of a process that never stored its result
+# (e.g. because it was killed) is ignored
+DEFAULT_TRELLO_CLAIM_TIMEOUT = 60
+# Maximum number of ids in a single query
+QUERY_CHUNK_SIZE = 500
+
+SCHEMA = ['''
+CREATE TABLE IF NOT EXISTS entries (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (kind, id)
+)''', '''
+CREATE TABLE IF NOT EXISTS claims (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (kind, id)
+)''']
+
+
+class TrelloSharedStore(object):
+    '''SQLite store of trello cards and lists, safe for concurrent processes.
+
+    Entries are reused for ttl seconds.  Fetching a missing, or expired,
+    entry first claims it, so only one process fetches a given card, list
+    or board while any others wait for, and reuse, its result.  Every write
+    is a single transaction, so readers never observe partial updates.
+    '''
+
+    def __init__(self, path, ttl=DEFAULT_TRELLO_SHARED_CACHE_TTL, claim_timeout=DEFAULT_TRELLO_CLAIM_TIMEOUT):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        self.owner = '%s:%d' % (os.uname()[1] if hasattr(os, 'uname') else '', os.getpid())
+        self._local = threading.local()
+        # Processes starting together would otherwise race to create tables
+        with self.transaction() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    @property
+    def connection(self):
+        '''A connection for the calling thread.'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def load(self, kind, ids):
+        '''Returns the unexpired entries of the provided ids as a dict of id
+        to (data, fetched).'''
+        ids = list(ids)
+        expires = time.time() - self.ttl
+        entries = dict()
+        for start in range(0, len(ids), QUERY_CHUNK_SIZE):
+            chunk = ids[start:start + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                'SELECT id, data, fetched FROM entries WHERE kind = ? AND fetched >= ? AND id IN (%s)' %
+                ','.join('?' * len(chunk)), [kind, expires] + chunk)
+            for (id, data, fetched) in rows:
+                entries[id] = (json.loads(data), fetched)
+        return entries
+
+    @contextmanager
+    def transaction(self):
+        '''Run the with block in a single, write-locked, transaction.'''
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        committed = False
+        try:
+            yield connection
+            connection.execute('COMMIT')
+            committed = True
+        finally:
+            if not committed:
+                connection.execute('ROLLBACK')
+
+    def store(self, kind, entries):
+        '''Atomically store a dict of id to (data, fetched).'''
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO entries (kind, id, data, fetched) VALUES (?, ?, ?, ?)',
+                [(kind, id, json.dumps(data), fetched) for (id, (data, fetched)) in entries.items()])
+
+    def claim(self, kind, ids):
+        '''Returns the ids of the provided entries the calling process may
+        fetch, as they are neither stored (unexpired) nor being fetched by
+        another process.  These must be passed to release() once fetched
+        (and stored).  Checking the store within the same transaction means
+        an entry stored after the caller last loaded it is never claimed.'''
+        now = time.time()
+        claimed = []
+        with self.transaction() as connection:
+            for id in ids:
+                if connection.execute('SELECT 1 FROM entries WHERE kind = ? AND id = ? AND fetched >= ?',
+                                      (kind, id, now - self.ttl)).fetchone() is not None:
+                    continue
+                connection.execute('DELETE FROM claims WHERE kind = ? AND id = ? AND expires < ?', (kind, id, now))
+                if connection.execute('INSERT OR IGNORE INTO claims (kind, id, owner, expires) VALUES (?, ?, ?, ?)',
+                                      (kind, id, self.owner, now + self.claim_timeout)).rowcount == 1:
+                    claimed.append(id)
+        return claimed
+
+    def release(self, kind, ids):
+        with self.transaction() as connection:
+            connection.executemany('DELETE FROM claims WHERE kind = ? AND id = ? AND owner = ?',
+                                   [(kind, id, self.owner) for id in ids])
+
+    def _claimed(self, kind, id):
+        return self.connection.execute('SELECT 1 FROM claims WHERE kind = ? AND id = ? AND expires >= ?',
+                                       (kind, id, time.time())).fetchone() is not None
+
+    def fetch(self, kind, id, fetch):
+        '''Returns (data, fetched) of an entry, calling fetch() to retrieve it
+        when it is missing or expired, unless another process is already
+        fetching it.  Any exception raised by fetch() is propagated.'''
+        while True:
+            entry = self.load(kind, [id]).get(id)
+            if entry is not None:
+                return entry
+            if self.claim(kind, [id]):
+                try:
+                    entry = (fetch(), time.time())
+                    self.store(kind, {id: entry})
+                    return entry
+                finally:
+                    self.release(kind, [id])
+
+            # Wait for the process holding the claim
+            log.debug("Waiting for another process to fetch %s:%s" % (kind, id))
+            while self._claimed(kind, id):
+                time.sleep(0.05)
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import logging
+import optparse
+import yaml
+import pytest
+import trello
+import requests.exceptions
+from pytest_trello.session import TrelloSession, TRELLO_API_URL
+
+if sys.version_info < (3, 0):
+    from ConfigParser import RawConfigParser, Error as ConfigParserError
+else:
+    from configparser import RawConfigParser, Error as ConfigParserError
+
+try:
+    from logging import NullHandler
+except ImportError:
+    from logging import Handler
+    class NullHandler(Handler):
+        def emit(self, record):
+            pass
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+"""
+pytest-trello
+~~~~~~~~~~~~
+
+Incremental sync of cached cards and lists from the actions of their boards.
+
+:copyright: see LICENSE for details
+:license: MIT, see LICENSE for more details.
+"""
+
+# Board actions that change the name, list or status of a card or list
+TRELLO_SYNC_ACTIONS = ['updateCard', 'updateList', 'deleteCard', 'moveCardFromBoard', 'moveListFromBoard']
+# Maximum number of actions trello returns for a single request
+TRELLO_SYNC_LIMIT = 1000
+
+
+def isoformat(timestamp):
+    '''Returns a timestamp in the date format used by trello.'''
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.%03dZ' % (timestamp % 1 * 1000)
+
+
+def default_cache_dir(rootdir='.'):
+    '''Returns the pytest cache directory of the project in rootdir: the
+    cache_dir ini value, or the default of the installed pytest version.'''
+    for (name, section) in (('pytest.ini', 'pytest'), ('tox.ini', 'pytest'),
+                            ('setup.cfg', 'tool:pytest'), ('setup.cfg', 'pytest')):
+        path = os.path.join(rootdir, name)
+        if not os.path.isfile(path):
+            continue
+        parser = RawConfigParser()
+        try:
+            parser.read(path)
+            if parser.has_option(section, 'cache_dir'):
+                return os.path.join(rootdir, os.path.expandvars(parser.get(section, 'cache_dir')))
+        except ConfigParserError, e:
+            log.warning("Failed to read %s - %s" % (path, e))
+
+    if tuple(int(part) for part in pytest.__version__.split('.')[:2]) < (3, 4):
+        return os.path.join(rootdir, '.cache')
+    return os.path.join(rootdir, '.pytest_cache')
+
+
+class DirectoryCache(object):
+    '''Minimal stand-in for config.cache, reading and writing the values of a
+    pytest cache directory outside of a pytest session.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key, default):
+        try:
+            with open(os.path.join(self.path, 'v', key), 'r') as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return default
+
+    def set(self, key, value):
+        path = os.path.join(self.path, 'v', key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            json.dump(value, fd, indent=2, sort_keys=True)
+
+
+class TrelloSync(object):
+    '''Bring the cards and lists stored in the pytest cache up to date.
+
+    Rather than fetching every card again once it expires, a single request
+    per board retrieves the actions since the board was last synced (its
+    high-water mark).  Card moves, renames and archives are applied to the
+    cached cards and lists, and every cached entry of a synced board is
+    marked as freshly fetched.  Boards without a high-water mark are synced
+    from the time their oldest entry was fetched.  When more than
+    TRELLO_SYNC_LIMIT actions happened, entries are left to expire.
+    '''
+
+    def __init__(self, api, cache):
+        self.api = api
+        self.cache = cache
+
+    def get_actions(self, board_id, since):
+        '''Returns the actions of a board since the provided date, newest
+        first.  Uses the requests module of the trello library, so requests
+        go through any installed TrelloSession.'''
+        response = trello.boards.requests.get(
+            "%s/boards/%s/actions" % (TRELLO_API_URL, board_id),
+            params=dict(key=self.api._apikey, token=self.api._token, since=since,
+                        filter=','.join(TRELLO_SYNC_ACTIONS), limit=TRELLO_SYNC_LIMIT))
+        response.raise_for_status()
+        return json.loads(response.content)
+
+    def sync(self, boards=None):
+        '''Sync the provided boards (or every board with cached cards).
+        Returns the ids of all boards that were synced.'''
+        cached_cards = self.cache.get('trello/cards', {})
+        cached_lists = self.cache.get('trello/lists', {})
+        marks = self.cache.get('trello/boards', {})
+
+        # The oldest cached entry of every board
+        oldest = dict()
+        for entry in cached_cards.values():
+            board_id = entry['card'].get('idBoard')
+            if board_id is not None and (boards is None or board_id in boards):
+                oldest[board_id] = min(oldest.get(board_id, entry['fetched']), entry['fetched'])
+
+        synced = []
+        for (board_id, fetched) in sorted(oldest.items()):
+            since = marks.get(board_id, {}).get('since') or isoformat(fetched)
+            started = time.time()
+            try:
+                actions = self.get_actions(board_id, since)
+            except (ValueError, requests.exceptions.RequestException), e:
+                log.warning("Failed to sync board:%s - %s" % (board_id, e))
+                continue
+
+            if actions:
+                since = actions[0]['date']
+            marks[board_id] = dict(since=since, synced=started)
+            if len(actions) >= TRELLO_SYNC_LIMIT:
+                log.warning("Too many actions to sync board:%s, cached cards will expire" % board_id)
+                continue
+
+            self._apply(cached_cards, cached_lists, reversed(actions))
+            for cached in (cached_cards, cached_lists):
+                for entry in cached.values():
+                    data = entry.get('card', entry.get('list'))
+                    if data.get('idBoard') == board_id:
+                        entry['fetched'] = max(entry['fetched'], started)
+            synced.append(board_id)
+
+        self.cache.set('trello/cards', cached_cards)
+        self.cache.set('trello/lists', cached_lists)
+        self.cache.set('trello/boards', marks)
+        return synced
+
+    def _apply(self, cached_cards, cached_lists, actions):
+        '''Apply actions, oldest first, to the cached cards and lists.'''
+        # Cards are cached by the id used in their url, usually the shortLink
+        keys = dict()
+        for (key, entry) in cached_cards.items():
+            keys[entry['card'].get('id', key)] = key
+            keys[key] = key
+
+        for action in actions:
+            data = action.get('data', {})
+            if 'card' in data:
+                key = keys.get(data['card'].get('id'), keys.get(data['card'].get('shortLink')))
+                if key is None or key not in cached_cards:
+                    continue
+                if action['type'] in ('deleteCard', 'moveCardFromBoard'):
+                    del cached_cards[key]
+                    continue
+                card = cached_cards[key]['card']
+                for field in ('name', 'idList', 'closed'):
+                    if field in data['card']:
+                        card[field] = data['card'][field]
+                if 'listAfter' in data:
+                    card['idList'] = data['listAfter']['id']
+                    cached_lists.setdefault(card['idList'], dict(
+                        list=dict(data['listAfter'], idBoard=card.get('idBoard')), fetched=0))
+            elif 'list' in data and data['list'].get('id') in cached_lists:
+                if action['type'] == 'moveListFromBoard':
+                    del cached_lists[data['list']['id']]
+                    continue
+                lst = cached_lists[data['list']['id']]['list']
+                for field in ('name', 'closed'):
+                    if field in data['list']:
+                        lst[field] = data['list'][field]
+
+
+def main(args=None):
+    '''Console entry point syncing the pytest cache of a project, e.g. in a
+    pipeline stage ahead of the test run.'''
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--trello-cfg', dest='trello_cfg_file', default='trello.yml',
+                      help='Trello configuration file (default: %default)')
+    parser.add_option('--trello-api-key', default=None,
+                      help='Trello API key (defaults to value supplied in TRELLO_CFG)')
+    parser.add_option('--trello-api-token', default=None,
+                      help='Trello API token (defaults to value supplied in TRELLO_CFG)')
+    parser.add_option('--trello-api-url', default=TRELLO_API_URL,
+                      help='Base URL of the trello REST api (default: %default)')
+    parser.add_option('--cache-dir', default=None,
+                      help='pytest cache directory (default: cache_dir of the project, or .pytest_cache)')
+    parser.add_option('--board', dest='boards', action='append', default=None,
+                      help='Only sync the provided board id (may be repeated)')
+    (opts, args) = parser.parse_args(args)
+
+    trello_cfg = dict()
+    if os.path.isfile(opts.trello_cfg_file):
+        with open(opts.trello_cfg_file, 'r') as fd:
+            trello_cfg = (yaml.load(fd, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}).get('trello', {})
+    api = trello.TrelloApi(opts.trello_api_key or trello_cfg.get('key', None),
+                           opts.trello_api_token or trello_cfg.get('token', None))
+
+    session = TrelloSession(base_url=opts.trello_api_url)
+    session.install()
+    try:
+        synced = TrelloSync(api, DirectoryCache(opts.cache_dir or default_cache_dir())).sync(opts.boards)
+    finally:
+        session.close()
+    print("Synced %d trello boards" % len(synced))
+    return synced
+
+
+if __name__ == '__main__':
+    main()
@@ -132,6 +132,10 @@ setup(
         'pytest11': [
             'pytest-trello = pytest_trello.plugin'
         ],
+        'console_scripts': [
+            'pytest-trello-sync = pytest_trello.sync:main',
+            'pytest-trello-daemon = pytest_trello.daemon:main'
+        ],
     },
     zip_safe=False,
     tests_requires=['flake8', 'tox', 'trello', 'pytest'],
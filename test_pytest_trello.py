@@ -1,9 +1,34 @@
 # -*- coding: utf-8 -*-
+import os
+import py
 import pytest
+import requests
+import trello
 import inspect
 import re
+import sys
+import time
+import json
+import threading
 
-from _pytest.main import EXIT_OK, EXIT_NOTESTSCOLLECTED
+from _pytest.main import EXIT_OK, EXIT_NOTESTSCOLLECTED, EXIT_USAGEERROR
+
+# Local stand-in for the trello REST api, from the benchmark suite
+sys.path.insert(0, str(py.path.local(__file__).dirpath('benchmarks')))
+from fake_trello import FakeTrello  # noqa
+
+# Imported once by the plugin when activated, and kept alive here since
+# pytester removes modules imported during inline runs
+import pytest_trello  # noqa
+import pytest_trello.session  # noqa
+import pytest_trello.store  # noqa
+import pytest_trello.sync  # noqa
+import pytest_trello.daemon  # noqa
+
+# Keep any other submodules importable once testdir changes the working
+# directory, when the package was found through a relative sys.path entry
+# (e.g. python -m pytest from the checkout)
+pytest_trello.__path__[:] = [os.path.abspath(path) for path in pytest_trello.__path__]
 
 
 pytest_plugins = 'pytester',
@@ -143,7 +168,31 @@ def test_plugin_help(testdir):
         '* --trello-api-key=TRELLO_API_KEY',
         '* --trello-api-token=TRELLO_API_TOKEN',
         '* --trello-completed=TRELLO_COMPLETED',
+        '* --trello-workers=TRELLO_WORKERS',
+        '* --trello-api-url=TRELLO_API_URL',
+        '* --trello-pool-size=TRELLO_POOL_SIZE',
+        '* --trello-retries=TRELLO_RETRIES',
+        '* --trello-rate=TRELLO_RATE',
+        '* --trello-burst=TRELLO_BURST',
+        '* --trello-timeout=SECONDS',
+        '* --trello-timeout-total=SECONDS',
+        '* --trello-max-failures=TRELLO_MAX_FAILURES',
+        '* --trello-fallback=TRELLO_FALLBACK',
+        '* --trello-resolver=TRELLO_RESOLVER',
+        '* --trello-cache-ttl=TRELLO_CACHE_TTL',
+        '* --trello-cache-clear *',
+        '* --trello-cache-max-cards=TRELLO_CACHE_MAX_CARDS',
+        '* --trello-shared-cache=PATH',
+        '* --trello-shared-cache-ttl=SECONDS',
+        '* --trello-sync *',
+        '* --trello-stale-ok *',
+        '* --trello-daemon=SOCKET',
+        '* --trello-snapshot-write=PATH',
+        '* --trello-snapshot-read=PATH',
+        '* --trello-metrics-json=PATH',
         '* --show-trello-cards *',
+        '* --trello-report-format=TRELLO_REPORT_FORMAT',
+        '* --trello-report-output=PATH',
     ])
 
 
@@ -258,6 +307,20 @@ def test_pass_without_trello_card(testdir, option):
     assert result.parseoutcomes()['passed'] == 1
 
 
+def test_pass_without_trello_imports(testdir):
+    '''Verifies runs without trello markers neither import, nor configure, trello'''
+
+    testdir.makepyfile("""
+        import sys
+        def test_func(request):
+            assert request.config.pluginmanager.getplugin('trello_helper') is None
+            assert [name for name in ('yaml', 'trello', 'requests') if name in sys.modules] == []
+        """)
+    result = testdir.runpytest_subprocess()
+    assert result.ret == EXIT_OK
+    result.stdout.fnmatch_lines(['*1 passed*'])
+
+
 def test_fail_without_trello_card(testdir, option):
     '''Verifies test failure when no trello card is supplied'''
 
@@ -444,6 +507,917 @@ def test_collection_reporter(testdir, option, monkeypatch_trello, capsys):
     assert 'collected %s trello markers' % (len(CLOSED_CARDS) + len(OPEN_CARDS)) in stdout
 
 
+def test_card_url_variants(testdir, option, monkeypatch_trello, monkeypatch, capsys):
+    '''Verifies every spelling of a card url resolves to a single card'''
+
+    calls = []
+
+    def card_get(self, card_id, **kwargs):
+        calls.append(card_id)
+        return mock_trello_card_get(self, card_id, **kwargs)
+
+    monkeypatch.setattr('trello.cards.Cards.get', card_get)
+
+    urls = ['https://trello.com/c/openvariant', 'https://trello.com/c/openvariant/',
+            'https://trello.com/c/openvariant/42-some-slug', 'trello.com/c/openvariant?menu=filter', 'openvariant']
+    src = '\n'.join(["import pytest"] + ["""
+@pytest.mark.trello('%s')
+def test_func%d():
+    assert False
+""" % (url, i) for (i, url) in enumerate(urls)])
+    result = testdir.inline_runsource(src, *option.args)
+    assert_outcome(result, xfailed=len(urls))
+
+    assert calls == ['openvariant']
+    stdout, stderr = capsys.readouterr()
+    assert 'collected 1 trello markers' in stdout
+
+
+def test_prefetch_with_workers(testdir, option, monkeypatch_trello, monkeypatch):
+    '''Verifies cards and lists are resolved by the prefetch worker pool'''
+
+    callers = []
+
+    def card_get(self, card_id, **kwargs):
+        callers.append(threading.current_thread().name)
+        return mock_trello_card_get(self, card_id, **kwargs)
+
+    def list_get(self, list_id, **kwargs):
+        callers.append(threading.current_thread().name)
+        return mock_trello_list_get(self, list_id, **kwargs)
+
+    monkeypatch.setattr('trello.cards.Cards.get', card_get)
+    monkeypatch.setattr('trello.lists.Lists.get', list_get)
+
+    cards = ['https://trello.com/c/openpf%02d' % i for i in range(10)] + \
+        ['https://trello.com/c/closedpf%02d' % i for i in range(10)]
+    src = """
+        import pytest
+        @pytest.mark.trello(*%s)
+        def test_func():
+            assert False
+        """ % cards
+    args = option.args + ['--trello-workers', '4']
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+
+    # 20 cards, followed by 2 unique lists, all fetched outside of the main thread
+    assert len(callers) == 22
+    assert threading.current_thread().name not in callers
+
+
+def test_prefetch_pipelines_lists(testdir, option, monkeypatch_trello, monkeypatch):
+    '''Verifies a card's list is resolved as soon as the card arrives'''
+
+    calls = []
+
+    def card_get(self, card_id, **kwargs):
+        calls.append('card')
+        return mock_trello_card_get(self, card_id, **kwargs)
+
+    def list_get(self, list_id, **kwargs):
+        calls.append('list')
+        return mock_trello_list_get(self, list_id, **kwargs)
+
+    monkeypatch.setattr('trello.cards.Cards.get', card_get)
+    monkeypatch.setattr('trello.lists.Lists.get', list_get)
+
+    src = """
+        import pytest
+        @pytest.mark.trello('%s', '%s')
+        def test_func():
+            assert False
+        """ % (OPEN_CARDS[0], CLOSED_CARDS[0])
+    result = testdir.inline_runsource(src, *(option.args + ['--trello-workers', '1']))
+    assert_outcome(result, xfailed=1)
+    assert calls == ['card', 'list', 'card', 'list']
+
+
+def test_prefetch_with_board_resolver(testdir, option, monkeypatch_trello, monkeypatch):
+    '''Verifies --trello-resolver=board resolves cards from their board'''
+
+    cards = ['https://trello.com/c/openbd%02d' % i for i in range(5)] + \
+        ['https://trello.com/c/closedbd%02d' % i for i in range(5)]
+    calls = []
+
+    def card_get(self, card_id, **kwargs):
+        calls.append(('card', card_id))
+        return mock_trello_card_get(self, card_id, **kwargs)
+
+    def board_get_card(self, board_id, **kwargs):
+        calls.append(('board_cards', board_id))
+        result = []
+        for card in cards:
+            data = mock_trello_card_get(self, card.rsplit('/', 1)[-1])
+            data['shortLink'] = card.rsplit('/', 1)[-1]
+            result.append(data)
+        return result
+
+    def board_get_list(self, board_id, **kwargs):
+        calls.append(('board_lists', board_id))
+        return [mock_trello_list_get(self, list_id) for list_id in
+                ('open53f20bbd90cfc68effae9544', 'closed53f20bbd90cfc68effae9544')]
+
+    monkeypatch.setattr('trello.cards.Cards.get', card_get)
+    monkeypatch.setattr('trello.boards.Boards.get_card', board_get_card)
+    monkeypatch.setattr('trello.boards.Boards.get_list', board_get_list)
+
+    src = """
+        import pytest
+        @pytest.mark.trello(*%s)
+        def test_open():
+            assert False
+
+        @pytest.mark.trello(*%s)
+        def test_closed():
+            assert False
+        """ % (cards[:5], cards[5:])
+    args = option.args + ['--trello-resolver', 'board']
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, failed=1, xfailed=1)
+
+    # A single card lookup discovers the board, which resolves everything else
+    assert len(calls) == 3
+    assert [call[0] for call in calls[1:]] == ['board_cards', 'board_lists']
+
+
+def test_board_resolver_with_failed_board(testdir, option, monkeypatch_trello, monkeypatch):
+    '''Verifies --trello-resolver=board requests a board that failed only once'''
+
+    calls = []
+
+    def card_get(self, card_id, **kwargs):
+        calls.append('card')
+        return mock_trello_card_get(self, card_id, **kwargs)
+
+    def board_get_card(self, board_id, **kwargs):
+        calls.append('board_cards')
+        raise requests.exceptions.HTTPError('500 Server Error')
+
+    monkeypatch.setattr('trello.cards.Cards.get', card_get)
+    monkeypatch.setattr('trello.boards.Boards.get_card', board_get_card)
+
+    cards = ['https://trello.com/c/openbf%02d' % i for i in range(10)]
+    src = """
+        import pytest
+        @pytest.mark.trello(*%s)
+        def test_func():
+            assert False
+        """ % cards
+    args = option.args + ['--trello-resolver', 'board', '--trello-max-failures', '0']
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+
+    # Every card is resolved individually once its board failed
+    assert sorted(calls) == ['board_cards'] + ['card'] * 10
+
+
+def test_cache_ttl(testdir, option, monkeypatch_trello, monkeypatch):
+    '''Verifies --trello-cache-ttl reuses cards stored in the pytest cache'''
+
+    calls = []
+
+    def card_get(self, card_id, **kwargs):
+        calls.append(card_id)
+        return mock_trello_card_get(self, card_id, **kwargs)
+
+    monkeypatch.setattr('trello.cards.Cards.get', card_get)
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/opencache')
+        def test_func():
+            assert False
+        """
+    for (args, expected_calls) in ((['--trello-cache-ttl', '60'], 1),
+                                   (['--trello-cache-ttl', '60'], 1),
+                                   (['--trello-cache-ttl', '60', '--trello-cache-clear'], 2),
+                                   ([], 3)):
+        result = testdir.inline_runsource(src, *(option.args + args))
+        assert_outcome(result, xfailed=1)
+        assert len(calls) == expected_calls
+
+
+def test_minimal_payloads(testdir, option, fake_trello):
+    '''Verifies only the card and list fields used by the plugin are requested, and cached'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card00001')
+        def test_func():
+            assert False
+        """
+    args = option.args + ['--trello-api-url', fake_trello.url, '--trello-cache-ttl', '60']
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+
+    cache = testdir.parseconfigure().cache
+    cards = cache.get('trello/cards', None)
+    assert cards['card00001']['card'] == dict(id='card00001', shortLink='card00001', name='synthetic card 1',
+                                              idBoard='board0', idList='board0-list1', closed=False)
+    lists = cache.get('trello/lists', None)
+    assert lists['board0-list1']['list'] == dict(id='board0-list1', idBoard='board0', name='Doing', closed=False)
+
+
+def test_verdict_once_per_card_set(testdir, option, monkeypatch_trello, monkeypatch):
+    '''Verifies items linked to the same cards share a single verdict'''
+
+    from pytest_trello.plugin import TrelloPytestPlugin
+    calls = []
+    verdict = TrelloPytestPlugin.verdict
+
+    def count_verdict(self, cards):
+        calls.append(cards.cards)
+        return verdict(self, cards)
+
+    monkeypatch.setattr(TrelloPytestPlugin, 'verdict', count_verdict)
+
+    src = """
+        import pytest
+        @pytest.mark.parametrize('value', range(50))
+        @pytest.mark.trello(*%s)
+        def test_foo(value):
+            assert False
+
+        @pytest.mark.trello(*%s)
+        def test_bar():
+            assert False
+        """ % (OPEN_CARDS, CLOSED_CARDS)
+    result = testdir.inline_runsource(src, *option.args)
+    assert_outcome(result, xfailed=50, failed=1)
+    # Cards are identified by their canonical id, rather than their url
+    assert sorted(calls) == [tuple(sorted(url.rsplit('/', 1)[-1] for url in urls)) for urls in (CLOSED_CARDS, OPEN_CARDS)]
+
+
+def test_cache_max_cards(testdir, option, fake_trello):
+    '''Verifies --trello-cache-max-cards keeps only the most recently used cards in the pytest cache'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card%05d')
+        def test_func():
+            assert False
+        """
+    args = option.args + ['--trello-api-url', fake_trello.url, '--trello-cache-ttl', '60',
+                          '--trello-cache-max-cards', '2']
+    for number in (0, 1, 2, 0):
+        result = testdir.inline_runsource(src % number, *args)
+        assert_outcome(result, failed=1 - number % 2, xfailed=number % 2)
+
+    cache = testdir.parseconfigure().cache
+    assert sorted(cache.get('trello/cards', None)) == ['card00000', 'card00002']
+    assert sorted(cache.get('trello/lists', None)) == ['board0-list0']
+
+
+def test_lists_fetched_once(testdir, option, monkeypatch_trello, monkeypatch):
+    '''Verifies each trello list is retrieved once per session'''
+
+    calls = []
+
+    def list_get(self, list_id, **kwargs):
+        calls.append(list_id)
+        return mock_trello_list_get(self, list_id, **kwargs)
+
+    monkeypatch.setattr('trello.lists.Lists.get', list_get)
+
+    src = """
+        import pytest
+        @pytest.mark.trello(*%s)
+        def test_foo():
+            assert False
+
+        @pytest.mark.trello(*%s)
+        def test_bar():
+            assert False
+        """ % (ALL_CARDS, OPEN_CARDS)
+    result = testdir.inline_runsource(src, *option.args)
+    assert_outcome(result, xfailed=2)
+    assert sorted(calls) == ['closed53f20bbd90cfc68effae9544', 'open53f20bbd90cfc68effae9544']
+
+
+def test_xdist_resolves_once(testdir, option):
+    '''Verifies pytest-xdist workers share a single resolution of all cards,
+    which the controller writes to --trello-snapshot-write'''
+
+    pytest.importorskip('xdist')
+
+    # Workers run in separate processes, so mock trello in a conftest.py that
+    # records every call in a file
+    calls = testdir.tmpdir.join('calls.txt')
+    testdir.makeconftest("""
+        import sys
+        sys.path.insert(0, %r)
+        import test_pytest_trello
+
+        def record(func):
+            def wrapper(self, id, **kwargs):
+                with open(%r, 'a') as fd:
+                    fd.write(id + '\\n')
+                return func(self, id, **kwargs)
+            return wrapper
+
+        import trello
+        trello.cards.Cards.get = record(test_pytest_trello.mock_trello_card_get)
+        trello.lists.Lists.get = record(test_pytest_trello.mock_trello_list_get)
+        """ % (str(py.path.local(__file__).dirpath()), str(calls)))
+    testdir.makepyfile("""
+        import pytest
+        @pytest.mark.trello(*%s)
+        def test_func(): pass
+        """ % ALL_CARDS + ''.join(["""
+        @pytest.mark.trello('%s')
+        def test_func%d(): pass
+        """ % (card, i) for (i, card) in enumerate(ALL_CARDS)]))
+
+    snapshot = testdir.tmpdir.join('snapshot.json')
+    result = testdir.runpytest_subprocess(*(option.args + ['-n', '3', '--trello-snapshot-write', str(snapshot)]))
+    assert result.ret == EXIT_OK
+
+    # 4 cards and 2 lists, regardless of the number of workers
+    assert len(calls.readlines()) == 6
+    cards = json.loads(snapshot.read())['cards']
+    assert sorted(cards.keys()) == sorted(card.rsplit('/', 1)[-1] for card in ALL_CARDS)
+
+
+def test_snapshot_write_and_read(testdir, option, monkeypatch_trello, monkeypatch):
+    '''Verifies cards written with --trello-snapshot-write are used offline by
+    --trello-snapshot-read'''
+
+    snapshot = testdir.tmpdir.join('snapshot.json')
+    src = """
+        import pytest
+        @pytest.mark.trello(*%s)
+        def test_foo():
+            assert False
+
+        @pytest.mark.trello(*%s)
+        def test_bar():
+            assert False
+        """ % (CLOSED_CARDS, OPEN_CARDS)
+
+    result = testdir.inline_runsource(src, *(option.args + ['--trello-snapshot-write', str(snapshot)]))
+    assert_outcome(result, failed=1, xfailed=1)
+
+    cards = json.loads(snapshot.read())['cards']
+    assert sorted(cards.keys()) == sorted(card.rsplit('/', 1)[-1] for card in ALL_CARDS)
+    assert cards['open1234']['list'] == 'Not Done'
+    assert cards['closed12']['list'] == 'Done'
+
+    # Offline, the trello api is never used
+    monkeypatch.delattr('trello.TrelloApi')
+    result = testdir.inline_runsource(src, *(option.args + ['--trello-snapshot-read', str(snapshot)]))
+    assert_outcome(result, failed=1, xfailed=1)
+
+
+@pytest.mark.parametrize('content', [None, '{"version": 0, "cards": {}}', 'not json'])
+def test_snapshot_read_invalid(testdir, option, content):
+    '''Verifies a missing, or unsupported, --trello-snapshot-read is a usage error'''
+
+    snapshot = testdir.tmpdir.join('snapshot.json')
+    if content is not None:
+        snapshot.write(content)
+    result = testdir.runpytest(*(option.args + ['--trello-snapshot-read', str(snapshot)]))
+    assert result.ret == EXIT_USAGEERROR
+    result.stderr.fnmatch_lines([
+        '*Unable to read --trello-snapshot-read *snapshot.json*',
+    ])
+
+
+class MockAdapter(requests.adapters.BaseAdapter):
+    '''Transport adapter returning (or raising) the provided responses in order.'''
+
+    def __init__(self, *responses):
+        super(MockAdapter, self).__init__()
+        self.responses = list(responses)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        status = self.responses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        headers = {}
+        if isinstance(status, tuple):
+            (status, headers) = status
+        response = requests.models.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response.request = request
+        response.url = request.url
+        response._content = b'{}'
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('responses, retries, expected_status, expected_requests', [
+    ([200], 3, 200, 1),
+    ([503, 502, 200], 3, 200, 3),
+    ([requests.exceptions.ConnectionError(), 200], 3, 200, 2),
+    ([503, 503, 503], 2, 503, 3),
+    ([404, 200], 3, 404, 1),
+    ([(429, {'Retry-After': '0'}), 200], 3, 200, 2),
+])
+def test_session_retries(responses, retries, expected_status, expected_requests):
+    '''Verifies TrelloSession retries connection errors and 5xx responses'''
+
+    from pytest_trello.session import TrelloSession
+    session = TrelloSession(retries=retries, backoff=0)
+    adapter = MockAdapter(*responses)
+    session.session.mount('https://', adapter)
+
+    assert session.get('https://trello.com/1/cards/abc').status_code == expected_status
+    assert len(adapter.requests) == expected_requests
+
+
+def test_session_rate_limit():
+    '''Verifies TrelloSession waits for the limiter, and slows down on 429'''
+
+    from pytest_trello.session import TrelloSession, TokenBucket
+    limiter = TokenBucket(rate=50, burst=1)
+    session = TrelloSession(backoff=0, limiter=limiter)
+    adapter = MockAdapter((429, {'Retry-After': '0.1'}), 200, 200)
+    session.session.mount('https://', adapter)
+
+    start = time.time()
+    assert session.get('https://trello.com/1/cards/abc').status_code == 200
+    assert session.get('https://trello.com/1/cards/abc').status_code == 200
+    assert time.time() - start >= 0.1
+    assert len(adapter.requests) == 3
+    assert limiter.limited == 1
+    assert limiter.throttled >= 0.1
+    assert limiter.rate < limiter.max_rate
+
+
+def test_session_circuit_breaker():
+    '''Verifies TrelloSession stops contacting trello once the breaker opens'''
+
+    from pytest_trello.session import TrelloSession, CircuitBreaker, TrelloUnavailable
+    breaker = CircuitBreaker(max_failures=2)
+    session = TrelloSession(retries=0, backoff=0, breaker=breaker)
+    adapter = MockAdapter(503, 200, 503, 503, 200)
+    session.session.mount('https://', adapter)
+
+    assert session.get('https://trello.com/1/cards/abc').status_code == 503
+    assert session.get('https://trello.com/1/cards/abc').status_code == 200
+    assert session.get('https://trello.com/1/cards/abc').status_code == 503
+    assert not breaker.open
+    assert session.get('https://trello.com/1/cards/abc').status_code == 503
+    assert breaker.open
+    with pytest.raises(TrelloUnavailable):
+        session.get('https://trello.com/1/cards/abc')
+    assert len(adapter.requests) == 4
+
+
+def test_session_time_budget():
+    '''Verifies the circuit breaker opens once the time budget is spent'''
+
+    from pytest_trello.session import CircuitBreaker, TrelloUnavailable
+    breaker = CircuitBreaker(budget=0.5)
+    breaker.check()
+    breaker.record(True)
+    assert not breaker.open
+    time.sleep(0.6)
+    with pytest.raises(TrelloUnavailable):
+        breaker.check()
+    assert breaker.open
+
+
+def test_session_time_budget_slow_server():
+    '''Verifies retries, timeouts and backoff stop at the time budget'''
+
+    from pytest_trello.session import TrelloSession, CircuitBreaker, TrelloUnavailable
+    server = FakeTrello(cards=1, latency=3.0).start()
+    try:
+        session = TrelloSession(retries=3, backoff=1.0, timeout=1.0, breaker=CircuitBreaker(budget=1.0))
+        start = time.time()
+        with pytest.raises((requests.exceptions.Timeout, TrelloUnavailable)):
+            session.get(server.url + '/cards/card00000')
+        assert time.time() - start < 1.5
+        session.close()
+    finally:
+        server.stop()
+
+
+def test_session_install():
+    '''Verifies TrelloSession routes the trello library through the session'''
+
+    from pytest_trello.session import TrelloSession
+    session = TrelloSession()
+    original = trello.cards.requests
+
+    session.install()
+    try:
+        assert trello.cards.requests is session
+        assert trello.lists.requests is session
+    finally:
+        session.close()
+    assert trello.cards.requests is original
+
+
+@pytest.mark.parametrize('fallback, expected', [
+    ('complete', dict(failed=1)),
+    ('incomplete', dict(xfailed=1)),
+    ('cached', dict(xfailed=1)),
+])
+def test_fallback(testdir, option, monkeypatch_trello, monkeypatch, fallback, expected):
+    '''Verifies --trello-fallback decides the status of unavailable cards'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('%s')
+        def test_func():
+            assert False
+        """ % OPEN_CARDS[0]
+
+    # Populate the pytest cache with the last known status
+    result = testdir.inline_runsource(src, *(option.args + ['--trello-fallback', 'cached']))
+    assert_outcome(result, xfailed=1)
+
+    calls = []
+
+    def card_get(self, card_id, **kwargs):
+        calls.append(card_id)
+        raise requests.exceptions.HTTPError('503 Server Error')
+
+    monkeypatch.setattr('trello.cards.Cards.get', card_get)
+    result = testdir.inline_runsource(src, *(option.args + ['--trello-fallback', fallback]))
+    assert_outcome(result, **expected)
+
+    # Failures are remembered for the rest of the session
+    assert len(calls) == 1
+
+
+def test_collection_after_deselection(testdir, option, monkeypatch_trello, capsys):
+    '''Verifies only cards of selected items are collected'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello(*%s)
+        def test_foo():
+            assert True
+
+        @pytest.mark.trello(*%s)
+        def test_bar():
+            assert False
+        """ % (CLOSED_CARDS, OPEN_CARDS)
+    result = testdir.inline_runsource(src, *(option.args + ['-k', 'test_bar']))
+    assert_outcome(result, xfailed=1)
+
+    stdout, stderr = capsys.readouterr()
+    assert 'collected %s trello markers' % len(OPEN_CARDS) in stdout
+
+
+@pytest.fixture()
+def fake_trello(request):
+    '''Local stand-in for the trello REST api, from the benchmark suite.'''
+    server = FakeTrello(cards=4, lists=2).start()
+    request.addfinalizer(server.stop)
+    return server
+
+
+def test_trello_api_url(testdir, option, fake_trello):
+    '''Verifies --trello-api-url sends all requests to the provided server'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card00000', 'https://trello.com/c/card00002')
+        def test_done():
+            assert False
+
+        @pytest.mark.trello('https://trello.com/c/card00001')
+        def test_doing():
+            assert False
+        """
+    args = option.args + ['--trello-api-url', fake_trello.url]
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, failed=1, xfailed=1)
+    assert dict(fake_trello.stats) == {'cards': 3, 'lists': 2}
+
+
+def test_batch_resolver(testdir, option, fake_trello):
+    '''Verifies --trello-resolver=batch resolves cards, then their lists, in
+    batches of 10, handling missing cards individually'''
+
+    fake_trello.num_cards = 12
+    src = '\n'.join(["import pytest"] + ["""
+@pytest.mark.trello('https://trello.com/c/card%05d')
+def test_card%d():
+    assert False
+""" % (number, number) for number in range(12) + [99]])
+    args = option.args + ['--trello-api-url', fake_trello.url, '--trello-resolver', 'batch']
+    result = testdir.inline_runsource(src, *args)
+
+    # Cards on the 'Done' list (and the missing card99) are treated as complete
+    assert_outcome(result, failed=7, xfailed=6)
+    assert dict(fake_trello.stats) == {'batch': 3}
+
+
+def test_sync(testdir, option, fake_trello):
+    '''Verifies --trello-sync updates cached cards using one request per board'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card00000', 'https://trello.com/c/card00001')
+        def test_func():
+            assert False
+        """
+    args = option.args + ['--trello-api-url', fake_trello.url, '--trello-cache-ttl', '3600', '--trello-sync']
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+    assert dict(fake_trello.stats) == {'cards': 2, 'lists': 2}
+
+    # Move card00001 to 'Done', the cache is updated from the board actions
+    fake_trello.move_card(1, 0)
+    fake_trello.reset()
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, failed=1)
+    assert dict(fake_trello.stats) == {'boards/actions': 1}
+
+    # Move card00001 back, and sync using the console entry point, from the
+    # project directory
+    from pytest_trello.sync import main
+    fake_trello.move_card(1, 1)
+    fake_trello.reset()
+    assert main(['--trello-api-url', fake_trello.url]) == ['board0']
+    assert dict(fake_trello.stats) == {'boards/actions': 1}
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+    assert dict(fake_trello.stats) == {'boards/actions': 2}
+
+
+def test_stale_ok(testdir, option, fake_trello):
+    '''Verifies --trello-stale-ok answers from cached cards of any age, and
+    refreshes them in the background for the next session'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card00001')
+        def test_func():
+            assert False
+        """
+    args = option.args + ['--trello-api-url', fake_trello.url, '--trello-stale-ok', '--trello-cache-ttl', '1']
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+    assert dict(fake_trello.stats) == {'cards': 1, 'lists': 1}
+
+    # Cards younger than the cache ttl are not refreshed
+    fake_trello.reset()
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+    assert dict(fake_trello.stats) == {}
+
+    # Move card00001 to 'Done', the stale card is used while it is refreshed
+    time.sleep(1.1)
+    fake_trello.move_card(1, 0)
+    fake_trello.reset()
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+    assert dict(fake_trello.stats) == {'cards': 1, 'lists': 1}
+
+    # The next session uses the refreshed card
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, failed=1)
+
+
+def test_daemon(testdir, option, fake_trello):
+    '''Verifies --trello-daemon resolves cards through a running daemon, and falls back to trello otherwise'''
+
+    import subprocess
+    path = str(testdir.tmpdir.join('trello.sock'))
+    daemon = subprocess.Popen([sys.executable, '-m', 'pytest_trello.daemon', '--socket', path,
+                               '--trello-api-url', fake_trello.url, '--trello-rate', '0', '--refresh', '3600'])
+    try:
+        expires = time.time() + 10
+        while not testdir.tmpdir.join('trello.sock').check() and time.time() < expires:
+            time.sleep(0.05)
+
+        src = """
+            import pytest
+            @pytest.mark.trello('https://trello.com/c/card00000', 'https://trello.com/c/card00001')
+            def test_func():
+                assert False
+            """
+        args = option.args + ['--trello-api-url', fake_trello.url, '--trello-daemon', path]
+        for expected in ({'cards': 2, 'lists': 2}, {}):
+            fake_trello.reset()
+            result = testdir.inline_runsource(src, *args)
+            assert_outcome(result, xfailed=1)
+            assert dict(fake_trello.stats) == expected
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    fake_trello.reset()
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+    assert dict(fake_trello.stats) == {'cards': 2, 'lists': 2}
+
+
+def test_daemon_answers_warm_cards_while_fetching(tmpdir, fake_trello):
+    '''Verifies the daemon answers warm cards while other cards are fetched from trello'''
+
+    from pytest_trello.daemon import TrelloDaemon, query_daemon
+    from pytest_trello.session import TrelloSession
+    session = TrelloSession(base_url=fake_trello.url)
+    session.install()
+    daemon = TrelloDaemon(str(tmpdir.join('trello.sock')), trello.TrelloApi(None, None), refresh=3600).start()
+    try:
+        assert list(daemon.resolve(['card00000'])['cards']) == ['card00000']
+
+        fake_trello.latency = 1.0
+        cold = threading.Thread(target=daemon.resolve, args=(['card00001'],))
+        cold.start()
+        time.sleep(0.1)
+        start = time.time()
+        assert list(query_daemon(daemon.path, ['card00000'])['cards']) == ['card00000']
+        assert time.time() - start < 0.5
+        cold.join()
+    finally:
+        daemon.stop()
+        session.close()
+
+
+def test_shared_store_claim(tmpdir):
+    '''Verifies an entry stored by another process after it was last loaded is not claimed'''
+
+    from pytest_trello.store import TrelloSharedStore
+    (first, second) = [TrelloSharedStore(str(tmpdir.join('trello.db'))) for i in range(2)]
+    try:
+        assert first.load('cards', ['x']) == {}
+        assert second.fetch('cards', 'x', lambda: {'id': 'x'})[0] == {'id': 'x'}
+        assert first.claim('cards', ['x', 'y']) == ['y']
+        assert second.claim('cards', ['y']) == []
+        first.release('cards', ['y'])
+        assert second.claim('cards', ['y']) == ['y']
+    finally:
+        first.close()
+        second.close()
+
+
+@pytest.mark.parametrize('resolver, expected', [
+    ('card', {'cards': 2, 'lists': 2}),
+    ('batch', {'batch': 2}),
+    ('board', {'cards': 1, 'boards/cards': 1, 'boards/lists': 1}),
+])
+def test_shared_cache(testdir, option, fake_trello, resolver, expected):
+    '''Verifies concurrent processes using --trello-shared-cache fetch each card, list and board once'''
+
+    import subprocess
+    testdir.makepyfile("""
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card00000', 'https://trello.com/c/card00001')
+        def test_func():
+            assert False
+        """)
+    fake_trello.latency = 0.2
+    args = [sys.executable, '-m', 'pytest', '-p', 'no:cacheprovider', '--trello-api-url', fake_trello.url,
+            '--trello-shared-cache', str(testdir.tmpdir.join('trello.db')), '--trello-resolver', resolver] + option.args
+    processes = [subprocess.Popen(args, cwd=str(testdir.tmpdir), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                 for i in range(4)]
+    for process in processes:
+        stdout = process.communicate()[0]
+        assert process.returncode == EXIT_OK, stdout
+        assert '1 xfailed' in stdout
+    assert dict(fake_trello.stats) == expected
+
+
+def test_metrics(testdir, option, fake_trello, capsys):
+    '''Verifies trello requests are reported in the terminal summary and as JSON'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card00000', 'https://trello.com/c/card00001')
+        def test_func():
+            assert False
+        """
+    path = testdir.tmpdir.join('metrics.json')
+    args = option.args + ['--trello-api-url', fake_trello.url, '--trello-metrics-json', str(path),
+                          '--trello-rate', '20', '--trello-burst', '1']
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+
+    stdout, stderr = capsys.readouterr()
+    assert '= trello metrics =' in stdout
+    assert 'requests: 4 (cards: 2, lists: 2), retries: 0, errors: 0' in stdout
+    assert 'rate limiter: max queue depth 2, throttled ' in stdout
+
+    metrics = json.loads(path.read())
+    assert metrics['total_requests'] == 4
+    assert metrics['requests'] == {'cards': 2, 'lists': 2}
+    assert metrics['max_queue_depth'] == 2
+    assert metrics['throttled'] > 0
+    assert metrics['rate_limited'] == 0
+    assert 'pytest_collection_finish' in metrics['hooks']
+    assert 'pytest_runtest_setup' in metrics['hooks']
+
+
+def test_metrics_without_trello_markers(testdir, option):
+    '''Verifies --trello-metrics-json writes zero counts when no trello markers are collected'''
+
+    src = """
+        def test_func():
+            pass
+        """
+    path = testdir.tmpdir.join('metrics.json')
+    result = testdir.inline_runsource(src, *(option.args + ['--trello-metrics-json', str(path)]))
+    assert_outcome(result, passed=1)
+
+    metrics = json.loads(path.read())
+    assert metrics['total_requests'] == 0
+    assert metrics['latency'] == {'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+
+
+@pytest.mark.parametrize('values, percent, expected', [
+    (range(1, 101), 50, 50),
+    (range(1, 101), 95, 95),
+    (range(1, 21), 95, 19),
+    ([1, 2, 3, 4], 50, 2),
+    ([4, 3, 2, 1], 100, 4),
+    ([7], 50, 7),
+    ([], 50, 0.0),
+])
+def test_metrics_percentile(values, percent, expected):
+    '''Verifies latency percentiles use the nearest rank'''
+
+    from pytest_trello.metrics import percentile
+    assert percentile(list(values), percent) == expected
+
+
+def test_prefetch_previous(testdir, option, fake_trello, capsys):
+    '''Verifies cards collected by the previous run are resolved while items
+    are collected, and only new cards are fetched afterwards'''
+
+    # Python 2 holds its import lock while importing test modules, so the
+    # slow part of collection is a hook instead
+    testdir.makeconftest("""
+        import time
+        def pytest_collection_modifyitems(items):
+            time.sleep(0.5)
+        """)
+    src = """
+        import pytest
+        @pytest.mark.trello(*%r)
+        def test_func():
+            assert False
+        """
+    path = testdir.tmpdir.join('metrics.json')
+    args = option.args + ['--trello-api-url', fake_trello.url, '--trello-metrics-json', str(path)]
+    fake_trello.latency = 0.2
+    result = testdir.inline_runsource(src % ['https://trello.com/c/card00000', 'https://trello.com/c/card00001'], *args)
+    assert_outcome(result, xfailed=1)
+
+    # card00000 is resolved, and released, although it is no longer referenced
+    fake_trello.reset()
+    capsys.readouterr()
+    src = src % ['https://trello.com/c/card00001', 'https://trello.com/c/card00002']
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+    assert dict(fake_trello.stats) == {'cards': 3, 'lists': 2}
+    stdout, stderr = capsys.readouterr()
+    assert 'collected 2 trello markers' in stdout
+
+    # All cards are resolved while the test module is collected
+    fake_trello.reset()
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, xfailed=1)
+    assert dict(fake_trello.stats) == {'cards': 2, 'lists': 2}
+    assert json.loads(path.read())['hooks']['pytest_collection_finish'] < 0.1
+
+
+def test_prefetch_previous_not_selected(testdir, option, fake_trello):
+    '''Verifies runs selecting no item of the previous run neither fetch,
+    nor wait for, the cards of that run'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card00001')
+        def test_func():
+            assert False
+        def test_plain():
+            pass
+        """
+    args = option.args + ['--trello-api-url', fake_trello.url]
+    result = testdir.inline_runsource(src, *args)
+    assert_outcome(result, passed=1, xfailed=1)
+
+    # Another selection has no previous cards
+    fake_trello.reset()
+    fake_trello.latency = 1.0
+    start = time.time()
+    result = testdir.inline_runsource(src, *(args + ['-k', 'plain']))
+    assert_outcome(result, passed=1)
+    assert time.time() - start < fake_trello.latency
+    assert dict(fake_trello.stats) == {}
+
+    # The same selection, no longer referencing the previous cards
+    start = time.time()
+    result = testdir.inline_runsource(src.replace("@pytest.mark.trello('https://trello.com/c/card00001')", ""), *args)
+    assert_outcome(result, passed=1, failed=1)
+    assert time.time() - start < fake_trello.latency
+
+
 def test_show_trello_report_with_no_cards(testdir, option, monkeypatch_trello, capsys):
     '''Verifies when a test succeeds with an open trello card'''
 
@@ -511,6 +1485,41 @@ def test_show_trello_report_with_cards(testdir, option, monkeypatch_trello, caps
     for card in OPEN_CARDS:
         assert re.search(r'^%s \[Not Done\]' % card, stdout, re.MULTILINE)
 
-    # this is weird, oh well
-    assert ' * {0}0/{0}.py:Test_Class().test_method'.format(module) in stdout
-    assert ' * {0}0/{0}.py:test_func'.format(module) in stdout
+    # Assert linked items are listed by node id
+    assert ' * {0}.py::Test_Class::()::test_method'.format(module) in stdout
+    assert ' * {0}.py::test_func'.format(module) in stdout
+
+
+def test_show_trello_report_formats(testdir, option, fake_trello):
+    '''Verifies --trello-report-format writes JSON and CSV reports grouped by board and list'''
+
+    src = """
+        import pytest
+        @pytest.mark.trello('https://trello.com/c/card00000', 'https://trello.com/c/card00001')
+        def test_foo():
+            assert True
+
+        @pytest.mark.trello('https://trello.com/c/card00002')
+        def test_bar():
+            assert True
+        """
+    path = testdir.tmpdir.join('report')
+    args = option.args + ['--trello-api-url', fake_trello.url, '--show-trello-cards', '--trello-report-output', str(path)]
+    module = inspect.stack()[0][3]
+
+    result = testdir.inline_runsource(src, *(args + ['--trello-report-format', 'json']))
+    assert result.ret == EXIT_OK
+    report = json.loads(path.read())
+    assert [(lst['name'], [card['id'] for card in lst['cards']]) for lst in report['boards'][0]['lists']] == \
+        [('Doing', ['card00001']), ('Done', ['card00000', 'card00002'])]
+    assert report['boards'][0]['lists'][1]['cards'][1] == {
+        'url': 'https://trello.com/c/card00002', 'id': 'card00002', 'name': 'synthetic card 2',
+        'status': 'complete', 'items': ['{0}.py::test_bar'.format(module)]}
+
+    result = testdir.inline_runsource(src, *(args + ['--trello-report-format', 'csv']))
+    assert result.ret == EXIT_OK
+    assert path.readlines(cr=False)[:2] == [
+        'board,idList,list,url,id,name,status,item',
+        'board0,board0-list1,Doing,https://trello.com/c/card00001,card00001,synthetic card 1,incomplete,{0}.py::test_foo'.format(module),
+    ]
+    assert dict(fake_trello.stats) == {'cards': 6, 'lists': 4}